@@ -1,14 +1,29 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Header, Request
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, IndexModel, ASCENDING, DESCENDING, ReturnDocument, CursorType
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError, CollectionInvalid
+from pymongo.read_concern import ReadConcern
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Literal
+from pydantic import BaseModel, Field, ConfigDict, field_validator
+from typing import List, Optional, Literal, Generic, TypeVar, Union, get_args
 import uuid
-from datetime import datetime, timezone
+import asyncio
+import base64
+import json
+import csv
+import io
+from datetime import datetime, timezone, timedelta
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import time
+import hashlib
+import heapq
 
 
 ROOT_DIR = Path(__file__).parent
@@ -16,9 +31,15 @@ load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
+# Identifies this process in leases and in the shared event log
+WORKER_ID = uuid.uuid4().hex
+
+# Report and catalog cache driver: memory:// (per process) or redis://...
+cache_url = os.environ.get('CACHE_URL', 'memory://')
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -34,6 +55,8 @@ class Category(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Write order for GET /sync; set on every insert and update
+    rev: Optional[int] = None
 
 class CategoryCreate(BaseModel):
     name: str
@@ -55,8 +78,12 @@ class Product(BaseModel):
     wholesale_price: float
     supplier_name: Optional[str] = None
     supplier_balance: Optional[float] = 0.0
+    # Scannable codes; each is unique across both fields of all products when set
+    sku: Optional[str] = None
+    barcode: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class ProductCreate(BaseModel):
     name: str
@@ -68,6 +95,16 @@ class ProductCreate(BaseModel):
     wholesale_price: float
     supplier_name: Optional[str] = None
     supplier_balance: Optional[float] = 0.0
+    sku: Optional[str] = None
+    barcode: Optional[str] = None
+
+    @field_validator("sku", "barcode")
+    @classmethod
+    def blank_code_is_none(cls, value: Optional[str]) -> Optional[str]:
+        # "" would still be indexed, so a second blank code would clash
+        if value is None:
+            return None
+        return value.strip() or None
 
 class ProductUpdate(BaseModel):
     name: Optional[str] = None
@@ -79,6 +116,16 @@ class ProductUpdate(BaseModel):
     wholesale_price: Optional[float] = None
     supplier_name: Optional[str] = None
     supplier_balance: Optional[float] = None
+    sku: Optional[str] = None
+    barcode: Optional[str] = None
+
+    @field_validator("sku", "barcode")
+    @classmethod
+    def blank_code_is_none(cls, value: Optional[str]) -> Optional[str]:
+        # "" would still be indexed, so a second blank code would clash
+        if value is None:
+            return None
+        return value.strip() or None
 
 class RestockProduct(BaseModel):
     quantity: float
@@ -99,6 +146,7 @@ class ProductSet(BaseModel):
     name: str
     items: List[SetItem]
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class ProductSetCreate(BaseModel):
     name: str
@@ -110,6 +158,7 @@ class ExpenseCategory(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class ExpenseCategoryCreate(BaseModel):
     name: str
@@ -128,6 +177,7 @@ class Expense(BaseModel):
     payment_source: Literal["cash", "gpay"] = "cash"
     date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class ExpenseCreate(BaseModel):
     category_id: str
@@ -145,6 +195,7 @@ class MoneyTransfer(BaseModel):
     description: Optional[str] = None
     date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class MoneyTransferCreate(BaseModel):
     transfer_type: Literal["cash_to_gpay", "gpay_to_cash", "customer_cash_to_gpay", "customer_gpay_to_cash", "cash_withdrawal", "gpay_withdrawal", "cash_deposit", "gpay_deposit"]
@@ -161,13 +212,23 @@ class Balance(BaseModel):
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # Sale Models
+class SaleItemComponent(BaseModel):
+    product_id: str
+    quantity: float
+    cost_price: float
+
 class SaleItem(BaseModel):
     product_id: Optional[str] = None
     set_id: Optional[str] = None
-    name: str
+    # SKU or barcode; name and prices default from the product when given
+    code: Optional[str] = None
+    name: Optional[str] = None
     quantity: float
-    unit_price: float
-    total: float
+    unit_price: Optional[float] = None
+    total: Optional[float] = None
+    # Unit cost at the time of sale; for sets, the cost of one set
+    cost_price: Optional[float] = None
+    components: Optional[List[SaleItemComponent]] = None
 
 class Sale(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -187,8 +248,11 @@ class Sale(BaseModel):
     gpay_return: Optional[float] = None
     amount_paid: Optional[float] = None
     balance_amount: Optional[float] = 0.0
+    # Id assigned by an offline POS client, unique across sales
+    client_id: Optional[str] = None
     date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class SaleCreate(BaseModel):
     sale_type: Literal["retail", "wholesale"]
@@ -202,8 +266,24 @@ class SaleCreate(BaseModel):
     cash_received: Optional[float] = None
     gpay_return: Optional[float] = None
     amount_paid: Optional[float] = None
+    client_id: Optional[str] = None
     date: Optional[datetime] = None
 
+# Most sales one POST /sales/batch call accepts
+SALE_BATCH_LIMIT = 500
+
+class BatchSaleCreate(SaleCreate):
+    client_id: str
+
+class SaleBatch(BaseModel):
+    sales: List[BatchSaleCreate] = Field(min_length=1, max_length=SALE_BATCH_LIMIT)
+
+class SaleBatchResult(BaseModel):
+    client_id: str
+    status: Literal["created", "duplicate", "rejected"]
+    sale_id: Optional[str] = None
+    detail: Optional[str] = None
+
 # Return/Refund Models
 class ReturnItem(BaseModel):
     product_id: Optional[str] = None
@@ -223,6 +303,7 @@ class Return(BaseModel):
     reason: Optional[str] = None
     date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    rev: Optional[int] = None
 
 class ReturnCreate(BaseModel):
     sale_id: str
@@ -231,35 +312,1886 @@ class ReturnCreate(BaseModel):
     reason: Optional[str] = None
     date: Optional[datetime] = None
 
+# Pagination Models
+T = TypeVar("T")
+
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None
+
+
+# ============= STORAGE CODEC =============
+
+# Timestamp fields shared by every stored model. They are written as native
+# BSON dates; documents written before the native-dates migration may still
+# hold ISO-8601 strings, which the read path converts transparently.
+DATE_FIELDS = ("date", "created_at", "updated_at")
+
+# True until the native-dates migration has rewritten every string date
+legacy_string_dates = True
+
+def as_utc(value: datetime) -> datetime:
+    """Return an aware UTC datetime, treating naive values as UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def to_storage(model: BaseModel) -> dict:
+    """Dump a model into a MongoDB document with native UTC dates"""
+    doc = model.model_dump()
+    for field in DATE_FIELDS:
+        if isinstance(doc.get(field), datetime):
+            doc[field] = as_utc(doc[field])
+    return doc
+
+def from_storage(doc: Optional[dict]) -> Optional[dict]:
+    """Normalise a stored document in place, accepting legacy ISO-string dates"""
+    if doc is None:
+        return None
+    for field in DATE_FIELDS:
+        value = doc.get(field)
+        if isinstance(value, str):
+            doc[field] = as_utc(datetime.fromisoformat(value))
+        elif isinstance(value, datetime):
+            doc[field] = as_utc(value)
+    return doc
+
+
+# ============= TRANSACTIONS =============
+
+# "auto" uses multi-document transactions when MongoDB runs as a replica set
+# (a single-node replica set is enough); "on" requires them, "off" disables them.
+transaction_mode = os.environ.get('MONGO_TRANSACTIONS', 'auto').lower()
+transactions_enabled = False
+
+async def is_replicated() -> bool:
+    """True when MongoDB is a replica set or sharded cluster"""
+    hello = await client.admin.command("hello")
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+async def detect_transaction_support():
+    """Decide at startup whether multi-step writes run inside transactions"""
+    global transactions_enabled
+    if transaction_mode == "off":
+        transactions_enabled = False
+    else:
+        supported = await is_replicated()
+        if transaction_mode == "on" and not supported:
+            raise RuntimeError("MONGO_TRANSACTIONS=on requires a replica set or sharded cluster")
+        transactions_enabled = supported
+    logger.info(f"Multi-document transactions {'enabled' if transactions_enabled else 'disabled'}")
+
+async def run_transaction(operation, read_concern: Optional[ReadConcern] = None):
+    """Run `operation(session)` atomically when transactions are enabled.
+
+    with_transaction retries the whole operation on TransientTransactionError
+    and retries the commit on UnknownTransactionCommitResult. Without
+    transactions the operation runs once with session=None.
+    """
+    if not transactions_enabled:
+        return await operation(None)
+    async with await client.start_session() as session:
+        return await session.with_transaction(operation, read_concern=read_concern)
+
 
 # ============= HELPER FUNCTIONS =============
 
-async def get_or_create_balance():
+async def get_or_create_balance(session=None):
     """Get or create the cash/gpay balance record"""
-    balance = await db.balances.find_one({"id": "main_balance"}, {"_id": 0})
-    if not balance:
-        balance_obj = Balance()
-        doc = balance_obj.model_dump()
-        doc['updated_at'] = doc['updated_at'].isoformat()
-        await db.balances.insert_one(doc)
-        return balance_obj.model_dump()
-    if isinstance(balance.get('updated_at'), str):
-        balance['updated_at'] = datetime.fromisoformat(balance['updated_at'])
-    return balance
+    balance = await db.balances.find_one_and_update(
+        {"id": "main_balance"},
+        {"$setOnInsert": to_storage(Balance())},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    return from_storage(balance)
 
-async def update_balance(cash_change: float = 0, gpay_change: float = 0):
-    """Update cash and gpay balances"""
-    balance = await get_or_create_balance()
-    new_cash = balance['cash'] + cash_change
-    new_gpay = balance['gpay'] + gpay_change
-    await db.balances.update_one(
+async def update_balance(cash_change: float = 0, gpay_change: float = 0, session=None):
+    """Atomically apply cash and gpay changes, returning the new balance"""
+    balance = await db.balances.find_one_and_update(
         {"id": "main_balance"},
-        {"$set": {
-            "cash": new_cash,
-            "gpay": new_gpay,
-            "updated_at": datetime.now(timezone.utc).isoformat()
+        {
+            "$inc": {"cash": cash_change, "gpay": gpay_change},
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        },
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    return from_storage(balance)
+
+async def debit_balance(source: str, amount: float, message: str, cash_change: float = 0, gpay_change: float = 0, session=None):
+    """Apply balance changes only if `source` holds at least `amount`.
+
+    The funds check and the update are a single conditional write, so
+    concurrent debits can never overdraw the balance.
+    """
+    balance = await db.balances.find_one_and_update(
+        {"id": "main_balance", source: {"$gte": amount}},
+        {
+            "$inc": {"cash": cash_change, "gpay": gpay_change},
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if balance is None:
+        current = await get_or_create_balance(session)
+        raise HTTPException(
+            status_code=400,
+            detail=f"{message}. Available: ₹{current[source]:.2f}, Required: ₹{amount:.2f}"
+        )
+    return from_storage(balance)
+
+# Balance effect of each transfer type as (cash sign, gpay sign), and the
+# message used when the side being debited cannot cover the amount
+TRANSFER_EFFECTS = {
+    # Own money: Cash → GPay
+    "cash_to_gpay": (-1, 1, "Insufficient cash balance"),
+    # Own money: GPay → Cash
+    "gpay_to_cash": (1, -1, "Insufficient GPay balance"),
+    # Customer gives cash, wants GPay from us (we receive cash, we send GPay)
+    "customer_cash_to_gpay": (1, -1, "Insufficient GPay balance to send to customer"),
+    # Customer wants cash, will GPay us (we receive GPay, we give cash)
+    "customer_gpay_to_cash": (-1, 1, "Insufficient cash balance to give to customer"),
+    # Withdraw from business
+    "cash_withdrawal": (-1, 0, "Insufficient cash balance to withdraw"),
+    "gpay_withdrawal": (0, -1, "Insufficient GPay balance to withdraw"),
+    # Deposit to business
+    "cash_deposit": (1, 0, None),
+    "gpay_deposit": (0, 1, None),
+}
+
+
+async def load_items_catalog(items: List[dict], session=None):
+    """Look up every product and set referenced by sale/return items.
+
+    Served from the catalog cache, so products carry price fields but no
+    quantity.
+    """
+    set_ids = {item['set_id'] for item in items if not item.get('product_id') and item.get('set_id')}
+    sets = await catalog_cache.get_many("product_sets", set_ids, session)
+    
+    product_ids = {item['product_id'] for item in items if item.get('product_id')}
+    for product_set in sets.values():
+        product_ids.update(set_item['product_id'] for set_item in product_set['items'])
+    products = await catalog_cache.get_many("products", product_ids, session)
+    return products, sets
+
+def snapshot_item_costs(items: List[dict], products: dict, sets: dict):
+    """Record the unit cost of each sale item, and of each set component, in place"""
+    for item in items:
+        if item.get('product_id'):
+            product = products.get(item['product_id'])
+            item['cost_price'] = product['cost_price'] if product else 0.0
+        elif item.get('set_id'):
+            product_set = sets.get(item['set_id'])
+            components = []
+            for set_item in (product_set['items'] if product_set else []):
+                product = products.get(set_item['product_id'])
+                components.append({
+                    "product_id": set_item['product_id'],
+                    "quantity": set_item['quantity'],
+                    "cost_price": product['cost_price'] if product else 0.0
+                })
+            item['components'] = components
+            item['cost_price'] = sum(c['quantity'] * c['cost_price'] for c in components)
+        else:
+            item['cost_price'] = 0.0
+
+def stock_deltas(items: List[dict], sets: dict, sign: int) -> dict:
+    """Net quantity change per product for sale/return items, expanding sets"""
+    deltas = {}
+    for item in items:
+        if item.get('product_id'):
+            deltas[item['product_id']] = deltas.get(item['product_id'], 0) + sign * item['quantity']
+        elif item.get('set_id') and item['set_id'] in sets:
+            for set_item in sets[item['set_id']]['items']:
+                quantity = sign * set_item['quantity'] * item['quantity']
+                deltas[set_item['product_id']] = deltas.get(set_item['product_id'], 0) + quantity
+    return deltas
+
+async def apply_stock_deltas(deltas: dict, products: dict, session=None, first_rev: Optional[int] = None):
+    """Apply per-product quantity changes in a single unordered bulk write.
+
+    `products` holds the current price fields, used to move the inventory
+    valuation by delta * price for each product. Quantities are not needed:
+    going from 0 to delta values exactly the change. Products take revs from
+    `first_rev` on, in `deltas` order, when the caller has reserved them.
+    """
+    if not deltas:
+        return
+    if first_rev is None:
+        async with revisions(len(deltas), session) as first:
+            await apply_stock_deltas(deltas, products, session, first)
+        return
+    now = datetime.now(timezone.utc)
+    await db.products.bulk_write(
+        [
+            UpdateOne({"id": product_id}, {"$inc": {"quantity": delta}, "$set": {"updated_at": now, "rev": first_rev + index}})
+            for index, (product_id, delta) in enumerate(deltas.items())
+        ],
+        ordered=False,
+        session=session
+    )
+    await apply_valuation_changes([
+        ({**products[product_id], "quantity": 0}, {**products[product_id], "quantity": delta})
+        for product_id, delta in deltas.items()
+        if product_id in products
+    ], session)
+
+
+# ============= INVENTORY VALUATION =============
+
+# inventory_valuation holds running stock value totals: one "overall"
+# document and one "category:<id>" document per category. Every change to a
+# product's quantity or prices moves them by the difference it makes.
+VALUATION_FIELDS = {
+    "cost_value": "cost_price",
+    "retail_value": "retail_price",
+    "wholesale_value": "wholesale_price"
+}
+
+def _product_valuation(product: dict, sign: int) -> dict:
+    increments = {
+        field: sign * (product.get(price) or 0) * (product.get('quantity') or 0)
+        for field, price in VALUATION_FIELDS.items()
+    }
+    increments['items'] = sign
+    return increments
+
+async def apply_valuation_changes(changes: List[tuple], session=None):
+    """Move the valuation totals for (before, after) product pairs.
+
+    `before` is None for a new product and `after` is None for a deleted one.
+    """
+    totals = {}
+    for before, after in changes:
+        for product, sign in ((before, -1), (after, 1)):
+            if product is None:
+                continue
+            for key in ("overall", f"category:{product['category_id']}"):
+                target = totals.setdefault(key, {})
+                for field, value in _product_valuation(product, sign).items():
+                    target[field] = target.get(field, 0) + value
+    if not totals:
+        return
+    now = datetime.now(timezone.utc)
+    await db.inventory_valuation.bulk_write(
+        [
+            UpdateOne({"id": key}, {"$inc": increments, "$set": {"updated_at": now}}, upsert=True)
+            for key, increments in totals.items()
+        ],
+        ordered=False,
+        session=session
+    )
+
+async def valuation_drift(session=None) -> dict:
+    """Stored totals minus the totals recomputed from the products, per key"""
+    pipeline = [
+        {"$group": {
+            "_id": "$category_id",
+            **{
+                field: {"$sum": {"$multiply": [{"$ifNull": [f"${price}", 0]}, {"$ifNull": ["$quantity", 0]}]}}
+                for field, price in VALUATION_FIELDS.items()
+            },
+            "items": {"$sum": 1}
         }}
+    ]
+    rows = await db.products.aggregate(pipeline, session=session).to_list(None)
+    fields = list(VALUATION_FIELDS) + ["items"]
+    expected = {"overall": {field: 0 for field in fields}}
+    for row in rows:
+        expected[f"category:{row['_id']}"] = {field: row[field] for field in fields}
+        for field in fields:
+            expected["overall"][field] += row[field]
+    
+    stored = {doc['id']: doc async for doc in db.inventory_valuation.find({}, {"_id": 0}, session=session)}
+    drift = {}
+    for key in set(expected) | set(stored):
+        want = expected.get(key, {field: 0 for field in fields})
+        have = stored.get(key, {})
+        diff = {field: have.get(field, 0) - want[field] for field in fields}
+        if any(abs(value) > 0.005 for value in diff.values()):
+            drift[key] = diff
+    return drift
+
+def _same_drift(diff: dict, previous: Optional[dict]) -> bool:
+    return previous is not None and all(
+        abs(value - previous.get(field, 0)) <= 0.005 for field, value in diff.items()
+    )
+
+async def correct_valuation_drift(drift: dict, session=None):
+    """Take `drift` off the totals with $inc, keeping writes made since it was measured"""
+    if not drift:
+        return
+    now = datetime.now(timezone.utc)
+    await db.inventory_valuation.bulk_write(
+        [
+            UpdateOne(
+                {"id": key},
+                {"$inc": {field: -value for field, value in diff.items()}, "$set": {"updated_at": now}},
+                upsert=True
+            )
+            for key, diff in drift.items()
+        ],
+        ordered=False,
+        session=session
+    )
+
+async def reconcile_inventory_valuation(immediate: bool = False) -> dict:
+    """Correct drift between the valuation totals and the products.
+
+    With transactions the aggregate and the correction run in one snapshot
+    transaction, so any drift found is real. Without them a sale can be seen
+    between its stock write and its valuation write, so a key is only
+    corrected once two runs in a row find the same drift for it, unless
+    `immediate` is set. Returns the drift found.
+    """
+    if transactions_enabled:
+        async def correct(session):
+            drift = await valuation_drift(session)
+            await correct_valuation_drift(drift, session)
+            return drift
+        drift = corrected = await run_transaction(correct, ReadConcern("snapshot"))
+    else:
+        drift = await valuation_drift()
+        if immediate:
+            corrected = drift
+        else:
+            state = await db.migrations.find_one({"id": "inventory_valuation"}, {"_id": 0, "pending_drift": 1})
+            previous = (state or {}).get('pending_drift') or {}
+            corrected = {key: diff for key, diff in drift.items() if _same_drift(diff, previous.get(key))}
+        await correct_valuation_drift(corrected)
+        await db.migrations.update_one(
+            {"id": "inventory_valuation"},
+            {"$set": {"pending_drift": {key: diff for key, diff in drift.items() if key not in corrected}}},
+            upsert=True
+        )
+    if corrected:
+        logger.warning(f"Inventory valuation drift corrected: {corrected}")
+    if len(drift) > len(corrected):
+        logger.info(f"Inventory valuation drift pending confirmation: {drift.keys() - corrected.keys()}")
+    return drift
+
+async def ensure_inventory_valuation():
+    """Build the totals on first start, before any write moves them.
+
+    The write handlers $inc with upsert, so on an existing database the first
+    sale would otherwise create "overall" holding only its own change.
+    """
+    state = await db.migrations.find_one({"id": "inventory_valuation"}, {"_id": 0})
+    if state and state.get('status') == "complete":
+        return
+    await reconcile_inventory_valuation(immediate=True)
+    await db.migrations.update_one(
+        {"id": "inventory_valuation"},
+        {"$set": {"status": "complete", "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    logger.info("Built inventory valuation totals")
+
+async def acquire_lease(name: str, seconds: float) -> bool:
+    """Claim or renew the lease `name` in db.migrations for this worker.
+
+    False while another worker holds it; an expired lease can be taken over.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        await db.migrations.find_one_and_update(
+            {"id": name, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+# Seconds between background reconciliations; 0 disables the job
+INVENTORY_RECONCILE_INTERVAL = float(os.environ.get('INVENTORY_RECONCILE_INTERVAL', '3600'))
+
+async def inventory_reconcile_loop():
+    """Reconcile periodically on whichever worker holds the reconcile lease"""
+    while True:
+        await asyncio.sleep(INVENTORY_RECONCILE_INTERVAL)
+        try:
+            if await acquire_lease("inventory_reconcile", 2 * INVENTORY_RECONCILE_INTERVAL):
+                await reconcile_inventory_valuation()
+        except Exception as e:
+            logger.error(f"Inventory valuation reconciliation failed: {e}")
+
+
+# ============= PAGINATION =============
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(value, doc_id: str) -> str:
+    """Opaque cursor for the (sort value, id) of the last document on a page.
+
+    `value` is a datetime, or the ISO string of a legacy string date.
+    """
+    if isinstance(value, str):
+        raw = json.dumps([value, doc_id, "string"]).encode()
+    else:
+        raw = json.dumps([as_utc(value).isoformat(), doc_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor: str):
+    """Return (value, id); value stays a string for a legacy string date"""
+    try:
+        parts = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        value, doc_id = parts[:2]
+        if len(parts) > 2:
+            return str(value), doc_id
+        return datetime.fromisoformat(value), doc_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def list_query(date_field: str, from_date: Optional[datetime], to_date: Optional[datetime], **filters) -> dict:
+    """Filter for list endpoints: [from_date, to_date) on date_field plus equality filters.
+
+    Like date_range_match, legacy ISO-string dates are matched too until the
+    native-dates migration completes.
+    """
+    query = {field: value for field, value in filters.items() if value is not None}
+    date_range = {}
+    if from_date is not None:
+        date_range["$gte"] = as_utc(from_date)
+    if to_date is not None:
+        date_range["$lt"] = as_utc(to_date)
+    if date_range and legacy_string_dates:
+        legacy = {operator: value.isoformat() for operator, value in date_range.items()}
+        query["$or"] = [{date_field: date_range}, {date_field: legacy}]
+    elif date_range:
+        query[date_field] = date_range
+    return query
+
+async def paginate(collection, query: dict, sort_field: str, limit: int, after: Optional[str] = None):
+    """Keyset-paginate newest first on (sort_field, id).
+
+    Each page is an index range scan on (sort_field, id) starting after the
+    cursor, so its cost does not depend on how many pages came before.
+    Until the native-dates migration completes, legacy ISO-string dates sort
+    below every native date, so they come after them, newest first.
+    """
+    if after:
+        value, last_id = decode_cursor(after)
+        # $lt only matches values of the cursor's own type
+        page = [
+            {sort_field: {"$lt": value}},
+            {sort_field: value, "id": {"$lt": last_id}}
+        ]
+        if legacy_string_dates and isinstance(value, datetime):
+            page.append({sort_field: {"$type": "string"}})
+        query = {"$and": [query, {"$or": page}]}
+    docs = await collection.find(query, {"_id": 0}) \
+        .sort([(sort_field, DESCENDING), ("id", DESCENDING)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+    
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        # Taken before from_storage so a legacy string stays a string
+        next_cursor = encode_cursor(docs[-1][sort_field], docs[-1]['id'])
+    return [from_storage(doc) for doc in docs], next_cursor
+
+async def list_documents(collection, query: dict, sort_field: str, limit: Optional[int], after: Optional[str], cap: int):
+    """Serve a list endpoint as a page when `limit` or `after` is given.
+
+    Without either, the full (capped) list is returned for existing clients.
+    """
+    if limit is None and after is None:
+        docs = await collection.find(query, {"_id": 0}).to_list(cap)
+        return [from_storage(doc) for doc in docs]
+    items, next_cursor = await paginate(collection, query, sort_field, limit or DEFAULT_PAGE_SIZE, after)
+    return {"items": items, "next_cursor": next_cursor}
+
+
+# ============= REPORT HELPERS =============
+
+def date_range_match(field: str, start: datetime, end: datetime) -> dict:
+    """Build a $match filter for documents whose date falls in [start, end).
+
+    Until the native-dates migration completes, legacy ISO-string dates are
+    matched too; both branches are plain range scans on the field's index.
+    """
+    native = {field: {"$gte": start, "$lt": end}}
+    if not legacy_string_dates:
+        return native
+    legacy = {field: {"$gte": start.isoformat(), "$lt": end.isoformat()}}
+    return {"$or": [native, legacy]}
+
+# Cost of goods of one sale: quantity * snapshotted unit cost over its items
+SALE_COST_EXPR = {"$sum": {"$map": {
+    "input": "$items",
+    "as": "item",
+    "in": {"$multiply": ["$$item.quantity", {"$ifNull": ["$$item.cost_price", 0]}]}
+}}}
+
+# UTC calendar day of a document's date; legacy ISO strings start with it
+DAY_EXPR = {"$cond": [
+    {"$eq": [{"$type": "$date"}, "string"]},
+    {"$substrCP": ["$date", 0, 10]},
+    {"$dateToString": {"format": "%Y-%m-%d", "date": "$date"}}
+]}
+
+async def aggregate_daily_rollups(start: datetime, end: datetime) -> List[dict]:
+    """Build rollup-shaped documents for [start, end) straight from sales and expenses"""
+    sales_pipeline = [
+        {"$match": date_range_match("date", start, end)},
+        {"$group": {
+            "_id": {"day": DAY_EXPR, "sale_type": "$sale_type"},
+            "total": {"$sum": "$total"},
+            "cost": {"$sum": SALE_COST_EXPR},
+            "discounts": {"$sum": "$discount_amount"},
+            "count": {"$sum": 1}
+        }}
+    ]
+    expenses_pipeline = [
+        {"$match": date_range_match("date", start, end)},
+        {"$group": {
+            "_id": {"day": DAY_EXPR, "category_id": "$category_id"},
+            "name": {"$last": "$category_name"},
+            "total": {"$sum": "$amount"},
+            "count": {"$sum": 1}
+        }}
+    ]
+    sales_rows, expense_rows = await asyncio.gather(
+        db.sales.aggregate(sales_pipeline).to_list(None),
+        db.expenses.aggregate(expenses_pipeline).to_list(None)
+    )
+    
+    rollups = {}
+    for row in sales_rows:
+        day, sale_type = row['_id']['day'], row['_id']['sale_type']
+        _merge_rollup(rollups.setdefault(day, {"id": day}), {
+            f"sales.{sale_type}.total": row['total'],
+            f"sales.{sale_type}.count": row['count'],
+            "cogs": row['cost'],
+            "discounts": row['discounts']
+        })
+    for row in expense_rows:
+        day, category_id = row['_id']['day'], row['_id']['category_id']
+        _merge_rollup(rollups.setdefault(day, {"id": day}), {
+            "expenses.total": row['total'],
+            "expenses.count": row['count'],
+            f"expenses.by_category.{category_id}.amount": row['total']
+        }, {f"expenses.by_category.{category_id}.name": row['name']})
+    return [rollups[day] for day in sorted(rollups)]
+
+
+# ============= DAILY ROLLUPS =============
+
+# daily_rollups holds one small document per store day (UTC), kept current by
+# the write handlers with $inc. Nested keys are category ids or fixed enum
+# values, never free text, so they are always valid field names. The day key
+# is also the _id, so change events name the day without a document lookup;
+# rollups written before that carry an ObjectId until the next rebuild.
+
+# Set once a full rebuild has populated daily_rollups; until then reports
+# fall back to aggregating the raw collections
+rollups_ready = False
+
+def day_start(value: datetime) -> datetime:
+    value = as_utc(value)
+    return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+
+def day_key(value: datetime) -> str:
+    return as_utc(value).strftime("%Y-%m-%d")
+
+def sale_cogs(items: List[dict]) -> float:
+    return sum(item['quantity'] * (item.get('cost_price') or 0) for item in items)
+
+def sale_rollup(sale: dict, sign: int = 1) -> dict:
+    cogs = sale_cogs(sale['items'])
+    return {
+        f"sales.{sale['sale_type']}.total": sign * sale['total'],
+        f"sales.{sale['sale_type']}.count": sign,
+        f"payment_methods.{sale['payment_method']}": sign * sale['total'],
+        "cogs": sign * cogs,
+        "discounts": sign * (sale.get('discount_amount') or 0)
+    }
+
+def expense_rollup(expense: dict, sign: int = 1) -> dict:
+    return {
+        "expenses.total": sign * expense['amount'],
+        "expenses.count": sign,
+        f"expenses.by_category.{expense['category_id']}.amount": sign * expense['amount']
+    }
+
+def return_rollup(ret: dict, sign: int = 1) -> dict:
+    return {
+        "returns.count": sign,
+        "returns.total": sign * sum(item['total'] for item in ret['items']),
+        f"returns.refunds.{ret['refund_method']}": sign * ret['refund_amount']
+    }
+
+def transfer_rollup(transfer: dict, sign: int = 1) -> dict:
+    return {
+        f"transfers.{transfer['transfer_type']}.amount": sign * transfer['amount'],
+        f"transfers.{transfer['transfer_type']}.count": sign
+    }
+
+async def bump_rollup(date: datetime, increments: dict, names: Optional[dict] = None, session=None):
+    """Apply increments to the rollup of the day containing `date`"""
+    update = {
+        "$inc": increments,
+        "$setOnInsert": {"_id": day_key(date), "date": day_start(date)}
+    }
+    if names:
+        update["$set"] = names
+    await db.daily_rollups.update_one({"id": day_key(date)}, update, upsert=True, session=session)
+
+def expense_category_name(expense: dict) -> dict:
+    return {f"expenses.by_category.{expense['category_id']}.name": expense['category_name']}
+
+def _merge_rollup(rollup: dict, increments: dict, names: Optional[dict] = None):
+    """Apply dotted-path increments to an in-memory rollup document"""
+    for path, value in list(increments.items()) + list((names or {}).items()):
+        node = rollup
+        *parents, leaf = path.split(".")
+        for key in parents:
+            node = node.setdefault(key, {})
+        if path in increments:
+            node[leaf] = node.get(leaf, 0) + value
+        else:
+            node[leaf] = value
+
+async def rebuild_rollups() -> int:
+    """Regenerate daily_rollups from the raw collections.
+
+    Uses the same per-document increments as the write handlers. Writes that
+    land while the rebuild runs may be lost, so run it when the shop is idle.
+    """
+    global rollups_ready
+    rollups = {}
+    
+    def rollup_for(date):
+        key = day_key(date)
+        if key not in rollups:
+            rollups[key] = {"id": key, "date": day_start(date)}
+        return rollups[key]
+    
+    sources = [
+        ("sales", sale_rollup),
+        ("expenses", expense_rollup),
+        ("returns", return_rollup),
+        ("money_transfers", transfer_rollup)
+    ]
+    for name, rollup_fn in sources:
+        async for doc in db[name].find({}, {"_id": 0}).batch_size(500):
+            from_storage(doc)
+            names = expense_category_name(doc) if name == "expenses" else None
+            _merge_rollup(rollup_for(doc['date']), rollup_fn(doc), names)
+    
+    # Also drops rollups still keyed by an ObjectId, which are rewritten below
+    await db.daily_rollups.delete_many({"_id": {"$nin": list(rollups)}})
+    if rollups:
+        await db.daily_rollups.bulk_write(
+            [ReplaceOne({"_id": key}, doc, upsert=True) for key, doc in rollups.items()],
+            ordered=False
+        )
+    await db.migrations.update_one(
+        {"id": "daily_rollups"},
+        {"$set": {"status": "complete", "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    rollups_ready = True
+    logger.info(f"Rebuilt {len(rollups)} daily rollups")
+    return len(rollups)
+
+def summarise_rollups(rollups: List[dict]) -> dict:
+    """Combine daily rollups into the summary shape used by the reports"""
+    retail = wholesale = count = cost = total_expenses = 0
+    expense_by_category = {}
+    for rollup in rollups:
+        sales = rollup.get('sales', {})
+        retail += sales.get('retail', {}).get('total', 0)
+        wholesale += sales.get('wholesale', {}).get('total', 0)
+        count += sales.get('retail', {}).get('count', 0) + sales.get('wholesale', {}).get('count', 0)
+        cost += rollup.get('cogs', 0)
+        expenses = rollup.get('expenses', {})
+        total_expenses += expenses.get('total', 0)
+        for category in expenses.get('by_category', {}).values():
+            if category.get('amount'):
+                name = category.get('name', "")
+                expense_by_category[name] = expense_by_category.get(name, 0) + category['amount']
+    
+    total_sales = retail + wholesale
+    return {
+        "sales": {
+            "total": total_sales,
+            "retail": retail,
+            "wholesale": wholesale,
+            "count": count
+        },
+        "expenses": {
+            "total": total_expenses,
+            "by_category": expense_by_category
+        },
+        "cost": cost,
+        "profit": total_sales - cost - total_expenses
+    }
+
+async def load_daily_rollups(start: datetime, end: datetime) -> List[dict]:
+    """Per-day totals for [start, end), from rollups once they have been built"""
+    if not rollups_ready:
+        return await aggregate_daily_rollups(start, end)
+    return await db.daily_rollups.find(
+        {"date": {"$gte": start, "$lt": end}}, {"_id": 0}
+    ).sort("date", ASCENDING).to_list(None)
+
+async def period_summary(start: datetime, end: datetime) -> dict:
+    """Report totals for [start, end)"""
+    return summarise_rollups(await load_daily_rollups(start, end))
+
+
+# ============= CACHE BACKENDS =============
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import RedisError
+except ImportError:  # only needed when CACHE_URL points at Redis
+    aioredis = None
+    RedisError = OSError
+
+class CacheBackend:
+    """Key/value store behind the report and catalog caches.
+
+    Keys can carry tags, and invalidate_tag drops every key carrying one.
+    Counters are version stamps: a reader compares one before and after a
+    slow read to tell whether an invalidation raced it.
+    """
+
+    # True when every worker sees the same entries
+    shared = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, key: str):
+        return (await self.get_many([key])).get(key)
+
+    async def set(self, key: str, value, ttl: Optional[float] = None, tags=()):
+        await self.set_many({key: value}, ttl, tags)
+
+    async def get_many(self, keys: List[str]) -> dict:
+        raise NotImplementedError
+
+    async def set_many(self, values: dict, ttl: Optional[float] = None, tags=()):
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+    async def invalidate_tag(self, tag: str):
+        raise NotImplementedError
+
+    async def counter(self, name: str) -> int:
+        raise NotImplementedError
+
+    async def incr(self, name: str) -> int:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+class MemoryCache(CacheBackend):
+    """Per-process LRU dict with optional per-entry TTL"""
+
+    def __init__(self, max_entries: int = 8192):
+        super().__init__()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.counters = {}
+
+    async def get_many(self, keys: List[str]) -> dict:
+        found = {}
+        now = time.monotonic()
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            value, expires, _ = entry
+            if expires is not None and expires <= now:
+                self._remove(key)
+                continue
+            self.entries.move_to_end(key)
+            found[key] = value
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def set_many(self, values: dict, ttl: Optional[float] = None, tags=()):
+        expires = None if ttl is None else time.monotonic() + ttl
+        for key, value in values.items():
+            self._remove(key)
+            self.entries[key] = (value, expires, tuple(tags))
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._remove(key)
+
+    async def invalidate_tag(self, tag: str):
+        self.invalidations += 1
+        for key in self.tags.pop(tag, set()):
+            self._remove(key)
+
+    async def counter(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    async def incr(self, name: str) -> int:
+        self.counters[name] = self.counters.get(name, 0) + 1
+        return self.counters[name]
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def stats(self) -> dict:
+        return {**super().stats(), "entries": len(self.entries)}
+
+class RedisCache(CacheBackend):
+    """Cache shared by every worker through a Redis-protocol server.
+
+    Values are stored as JSON, so datetimes come back as ISO strings. A tag
+    is a set of the keys stored under it; entries evicted by Redis itself
+    may linger in those sets until the tag is invalidated.
+
+    The cache must never take a sale down with it: while Redis is
+    unreachable every read is a miss and every write is skipped, and each
+    failure is logged.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "billing:"):
+        super().__init__()
+        if aioredis is None:
+            raise RuntimeError("CACHE_URL points at Redis but the redis package is not installed")
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+        self.errors = 0
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _failed(self, operation: str, error: Exception):
+        self.errors += 1
+        logger.error(f"Redis cache {operation} failed: {error}")
+
+    async def get_many(self, keys: List[str]) -> dict:
+        if not keys:
+            return {}
+        try:
+            raw = await self.redis.mget([self._key(key) for key in keys])
+        except (RedisError, OSError) as e:
+            self._failed("get", e)
+            raw = [None] * len(keys)
+        found = {key: json.loads(value) for key, value in zip(keys, raw) if value is not None}
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def set_many(self, values: dict, ttl: Optional[float] = None, tags=()):
+        if not values:
+            return
+        expires = None if ttl is None else int(ttl * 1000)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, value in values.items():
+                    pipe.set(self._key(key), json.dumps(jsonable_encoder(value)), px=expires)
+                for tag in tags:
+                    pipe.sadd(self._key(f"tag:{tag}"), *[self._key(key) for key in values])
+                await pipe.execute()
+        except (RedisError, OSError) as e:
+            self._failed("set", e)
+
+    async def delete(self, *keys: str):
+        if not keys:
+            return
+        try:
+            await self.redis.delete(*[self._key(key) for key in keys])
+        except (RedisError, OSError) as e:
+            self._failed("delete", e)
+
+    async def invalidate_tag(self, tag: str):
+        self.invalidations += 1
+        tag_key = self._key(f"tag:{tag}")
+        try:
+            keys = await self.redis.smembers(tag_key)
+            await self.redis.delete(tag_key, *keys)
+        except (RedisError, OSError) as e:
+            self._failed("tag invalidation", e)
+
+    async def counter(self, name: str) -> int:
+        try:
+            return int(await self.redis.get(self._key(f"counter:{name}")) or 0)
+        except (RedisError, OSError) as e:
+            self._failed("counter read", e)
+            return 0
+
+    async def incr(self, name: str) -> int:
+        try:
+            return await self.redis.incr(self._key(f"counter:{name}"))
+        except (RedisError, OSError) as e:
+            self._failed("counter increment", e)
+            return 0
+
+    async def close(self):
+        await self.redis.aclose()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "errors": self.errors}
+
+def open_cache_backend(url: str) -> CacheBackend:
+    """memory:// keeps entries per process; redis:// (or rediss://) shares them"""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    if url.startswith("memory://"):
+        return MemoryCache()
+    raise RuntimeError(f"Unsupported CACHE_URL: {url}")
+
+cache_backend = open_cache_backend(cache_url)
+
+
+# ============= REPORT CACHE =============
+
+# Seconds an entry for a period that has not ended yet may be served; a
+# safety net for writes made by other processes. Closed periods never expire.
+REPORT_CACHE_OPEN_TTL = float(os.environ.get('REPORT_CACHE_OPEN_TTL', '300'))
+
+class ReportCache:
+    """Cache of report responses keyed by (report type, period).
+
+    Write handlers invalidate the day, month and year a document belongs to,
+    so an entry is dropped exactly when its data changes. Entries for periods
+    that have ended are kept until such a write (e.g. a backdated sale)
+    happens.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(key: tuple) -> str:
+        return "reports:" + ":".join(key)
+
+    async def get(self, key: tuple):
+        value = await self.backend.get(self._key(key))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def generation(self) -> int:
+        """Version stamp to read before computing a report and pass to put()"""
+        return await self.backend.counter("reports")
+
+    async def put(self, key: tuple, value, generation: int, period_end: datetime):
+        """Store a report computed when the cache was at `generation`.
+
+        If anything was invalidated meanwhile the result may already be
+        stale, so it is not stored.
+        """
+        if generation != await self.generation():
+            return
+        closed = period_end <= datetime.now(timezone.utc)
+        ttl = None if closed else REPORT_CACHE_OPEN_TTL
+        await self.backend.set(self._key(key), value, ttl, tags=("reports",))
+
+    async def invalidate_date(self, date: datetime):
+        """Drop every cached report covering `date`, here and in other workers"""
+        await self.evict_date(date)
+        cache_sync.publish(f"reports:{day_key(as_utc(date))}")
+
+    async def evict_date(self, date: datetime):
+        date = as_utc(date)
+        await self.backend.incr("reports")
+        self.invalidations += 1
+        await self.backend.delete(*[
+            self._key(key)
+            for key in [("daily", day_key(date)), ("monthly", date.strftime("%Y-%m")), ("yearly", date.strftime("%Y"))]
+        ])
+
+    async def clear(self):
+        await self.evict_all()
+        cache_sync.publish("reports")
+
+    async def evict_all(self):
+        await self.backend.incr("reports")
+        self.invalidations += 1
+        await self.backend.invalidate_tag("reports")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+report_cache = ReportCache(cache_backend)
+
+
+# ============= CATALOG CACHE =============
+
+# Product fields that do not move with every sale; quantities are always
+# read from the database
+PRODUCT_CATALOG_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "category_id": 1, "unit": 1,
+    "cost_price": 1, "retail_price": 1, "wholesale_price": 1, "sku": 1, "barcode": 1
+}
+
+# kind -> (collection, projection, fields a document is looked up by)
+CATALOG_SOURCES = {
+    "categories": ("categories", {"_id": 0}, ("id",)),
+    "expense_categories": ("expense_categories", {"_id": 0}, ("id",)),
+    "products": ("products", PRODUCT_CATALOG_PROJECTION, ("id",)),
+    "product_codes": ("products", PRODUCT_CATALOG_PROJECTION, ("sku", "barcode")),
+    "product_sets": ("product_sets", {"_id": 0}, ("id",))
+}
+
+class CatalogCache:
+    """Read-through cache of reference data keyed by (kind, id or code).
+
+    Each kind carries a version counter that every invalidation bumps. A
+    lookup that misses only stores what it read if the version did not move
+    while it was reading, so a concurrent write can never be overwritten by
+    older data. Missing documents are not cached.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(kind: str, doc_id: str) -> str:
+        return f"catalog:{kind}:{doc_id}"
+
+    async def get_many(self, kind: str, ids, session=None) -> dict:
+        """Return {id: document} for the ids that exist, reading misses in one query"""
+        keys = {self._key(kind, doc_id): doc_id for doc_id in set(ids)}
+        if not keys:
+            return {}
+        cached = await self.backend.get_many(list(keys))
+        found = {keys[key]: doc for key, doc in cached.items()}
+        missing = [doc_id for doc_id in keys.values() if doc_id not in found]
+        self.hits += len(found)
+        
+        if missing:
+            self.misses += len(missing)
+            version = await self.backend.counter(f"catalog:{kind}")
+            collection, projection, fields = CATALOG_SOURCES[kind]
+            query = {"$or": [{field: {"$in": missing}} for field in fields]}
+            fetched = {}
+            async for doc in db[collection].find(query, projection, session=session):
+                for field in fields:
+                    if doc.get(field) in keys.values():
+                        fetched[doc[field]] = doc
+            found.update(fetched)
+            if fetched and version == await self.backend.counter(f"catalog:{kind}"):
+                await self.backend.set_many(
+                    {self._key(kind, doc_id): doc for doc_id, doc in fetched.items()},
+                    tags=("catalog", f"catalog:{kind}")
+                )
+        
+        # Callers may add to what they get back; keep the cached copies intact
+        return {doc_id: dict(doc) for doc_id, doc in found.items()}
+
+    async def get(self, kind: str, doc_id: str, session=None) -> Optional[dict]:
+        return (await self.get_many(kind, [doc_id], session)).get(doc_id)
+
+    async def invalidate(self, kind: str, doc_id: str):
+        """Drop one document, here and in other workers.
+
+        Also called on creates, so other workers add new products and sets
+        to their search index.
+        """
+        await self.evict(kind, doc_id)
+        cache_sync.publish(f"{kind}:{doc_id}")
+
+    async def evict(self, kind: str, doc_id: Optional[str] = None):
+        """Drop one document, or every document of `kind` when doc_id is None"""
+        await self.backend.incr(f"catalog:{kind}")
+        self.invalidations += 1
+        if doc_id is not None:
+            await self.backend.delete(self._key(kind, doc_id))
+        else:
+            await self.backend.invalidate_tag(f"catalog:{kind}")
+
+    async def clear(self):
+        for kind in CATALOG_SOURCES:
+            await self.backend.incr(f"catalog:{kind}")
+        self.invalidations += 1
+        await self.backend.invalidate_tag("catalog")
+
+    async def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "versions": {kind: await self.backend.counter(f"catalog:{kind}") for kind in CATALOG_SOURCES}
+        }
+
+catalog_cache = CatalogCache(cache_backend)
+
+
+# ============= CACHE COHERENCE =============
+
+# "auto" follows change streams on a replica set and polls cache_versions on a
+# standalone mongod; "changestream" and "polling" force one, "off" is for a
+# single worker.
+CACHE_SYNC = os.environ.get('CACHE_SYNC', 'auto').lower()
+CACHE_SYNC_POLL_INTERVAL = float(os.environ.get('CACHE_SYNC_POLL_INTERVAL', '0.5'))
+
+# Report invalidations follow daily_rollups, which every sale, expense, return
+# and transfer write (or reversal) bumps for its day. Sales are watched for
+# credit payments, which change the daily report but not the rollups.
+CATALOG_COLLECTIONS = sorted({source[0] for source in CATALOG_SOURCES.values()})
+
+# Sales and returns only move these product fields, none of which is cached
+STOCK_FIELDS = ["quantity", "updated_at", "rev"]
+
+# Filters run on the server, so a worker never receives (or looks up) a
+# change it would ignore. Rollup events name their day in documentKey and
+# need no lookup; the rarer catalog and credit payment updates do.
+ROLLUP_CHANGES = [{"$match": {"ns.coll": "daily_rollups"}}]
+RECORD_CHANGES = [{"$match": {"$or": [
+    {"ns.coll": "sales", "operationType": "update"},
+    {"ns.coll": {"$in": CATALOG_COLLECTIONS}, "operationType": {"$ne": "update"}},
+    {
+        "ns.coll": {"$in": CATALOG_COLLECTIONS},
+        "operationType": "update",
+        "$expr": {"$gt": [
+            {"$size": {"$setDifference": [
+                {"$map": {"input": {"$objectToArray": "$updateDescription.updatedFields"}, "in": "$$this.k"}},
+                STOCK_FIELDS
+            ]}},
+            0
+        ]}
+    }
+]}}]
+
+class CacheSync:
+    """Keeps the in-process caches of several workers coherent.
+
+    With change streams every worker watches the collections behind its
+    caches and evicts what changed. Without them, invalidations are published
+    as version bumps in cache_versions, which every worker polls.
+    """
+
+    def __init__(self):
+        self.mode = "off"
+        self.pending = set()
+        self.versions = {}
+        self.events = 0
+        self.restarts = 0
+
+    def publish(self, key: str):
+        """Queue an invalidation for other workers; only polling needs it"""
+        if self.mode == "polling":
+            self.pending.add(key)
+
+    async def apply(self, key: str):
+        """Evict local entries for an invalidation made by any worker"""
+        self.events += 1
+        scope, _, target = key.partition(":")
+        if scope == "reports":
+            if target:
+                await report_cache.evict_date(datetime.fromisoformat(target).replace(tzinfo=timezone.utc))
+            else:
+                await report_cache.evict_all()
+        elif scope in CATALOG_SOURCES and target:
+            # One document (or one code for product_codes) was written
+            await catalog_cache.evict(scope, target)
+            if scope in SEARCH_SOURCES:
+                doc = await db[scope].find_one({"id": target}, {"_id": 0, "name": 1})
+                if doc:
+                    search_index.add(SEARCH_SOURCES[scope], target, doc['name'])
+                else:
+                    search_index.remove(SEARCH_SOURCES[scope], target)
+        elif scope in CATALOG_SOURCES:
+            await catalog_cache.evict(scope)
+            if scope == "products":
+                await catalog_cache.evict("product_codes")
+            if scope in SEARCH_SOURCES:
+                await search_index.rebuild()
+
+    async def start(self):
+        # Even with a shared cache backend the search index is per process
+        if CACHE_SYNC == "auto":
+            self.mode = "changestream" if await is_replicated() else "polling"
+        else:
+            self.mode = CACHE_SYNC
+        logger.info(f"Cache coherence: {self.mode}")
+        if self.mode == "changestream":
+            background_tasks.append(asyncio.create_task(self.watch_loop(ROLLUP_CHANGES)))
+            background_tasks.append(asyncio.create_task(self.watch_loop(RECORD_CHANGES, "updateLookup")))
+        elif self.mode == "polling":
+            self.versions = {doc['id']: doc['version'] async for doc in db.cache_versions.find({}, {"_id": 0})}
+            background_tasks.append(asyncio.create_task(self.poll_loop()))
+
+    async def watch_loop(self, pipeline: List[dict], full_document: Optional[str] = None):
+        while True:
+            try:
+                async with db.watch(pipeline, full_document=full_document) as stream:
+                    async for change in stream:
+                        await self.handle_change(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Cache change stream failed, restarting: {e}")
+                # Changes made while the stream was down were missed
+                self.restarts += 1
+                await report_cache.evict_all()
+                await catalog_cache.clear()
+                await search_index.rebuild()
+                await asyncio.sleep(1)
+
+    async def handle_change(self, change: dict):
+        collection = change['ns']['coll']
+        doc = change.get('fullDocument')
+        if collection == "daily_rollups":
+            day = change['documentKey']['_id']
+            await self.apply(f"reports:{day}" if isinstance(day, str) else "reports")
+            return
+        if collection == "sales":
+            if doc:
+                from_storage(doc)
+                await self.apply(f"reports:{day_key(doc['date'])}")
+            return
+        # Catalog: deletes only carry the _id, so drop the whole kind
+        self.events += 1
+        if collection == "products":
+            await catalog_cache.evict("product_codes")
+        if doc and change['operationType'] != "delete":
+            await catalog_cache.evict(collection, doc['id'])
+            if collection in SEARCH_SOURCES:
+                search_index.add(SEARCH_SOURCES[collection], doc['id'], doc['name'])
+        else:
+            await catalog_cache.evict(collection)
+            if collection in SEARCH_SOURCES:
+                await search_index.rebuild()
+
+    async def flush(self):
+        """Write queued invalidations as version bumps"""
+        if not self.pending:
+            return
+        keys, self.pending = self.pending, set()
+        await db.cache_versions.bulk_write(
+            [
+                UpdateOne({"id": key}, {"$inc": {"version": 1}, "$currentDate": {"updated_at": True}}, upsert=True)
+                for key in keys
+            ],
+            ordered=False
+        )
+
+    async def poll_loop(self):
+        while True:
+            await asyncio.sleep(CACHE_SYNC_POLL_INTERVAL)
+            try:
+                await self.flush()
+                # Small: documents and days touched in the last day (TTL index)
+                async for doc in db.cache_versions.find({}, {"_id": 0}):
+                    if self.versions.get(doc['id']) != doc['version']:
+                        self.versions[doc['id']] = doc['version']
+                        await self.apply(doc['id'])
+            except Exception as e:
+                logger.error(f"Cache version poll failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "events": self.events,
+            "pending": len(self.pending),
+            "restarts": self.restarts
+        }
+
+cache_sync = CacheSync()
+
+
+# ============= IDEMPOTENCY =============
+
+# A claim still in progress after this many seconds is treated as abandoned
+# (e.g. the worker died) and the next retry runs the request again.
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+# How long a duplicate waits for the first request to finish before giving up
+IDEMPOTENCY_WAIT = 10
+
+async def run_idempotent(scope: str, key: Optional[str], input: BaseModel, operation, after=None, transactional: bool = False):
+    """Run `operation(session)` at most once per Idempotency-Key.
+
+    The first request claims the key in idempotency_keys and stores its
+    response (or HTTP error) when done; duplicates get that stored outcome,
+    waiting while the first one is still running. Reusing a key for a
+    different request body is rejected with 422. Keys expire after a day.
+
+    With `transactional` and transactions enabled, the operation and its
+    stored response commit in one transaction. Otherwise the response is
+    written after the operation, so a worker dying in between leaves the
+    key in progress and a retry after IDEMPOTENCY_LOCK_TIMEOUT runs the
+    request again: that can still happen without transactions, and always
+    for expenses, which are not transactional.
+
+    Follow-up work (cache invalidation, events) goes in `after(result)`,
+    which runs once the outcome is stored and cannot fail the request: a
+    500 there would release the key and let a retry write everything a
+    second time.
+    """
+    if not key:
+        result = await (run_transaction(operation) if transactional else operation(None))
+        await after_write(after, result)
+        return result
+    
+    record_id = f"{scope}:{key}"
+    request_hash = hashlib.sha256(
+        json.dumps(jsonable_encoder(input), sort_keys=True).encode()
+    ).hexdigest()
+    now = datetime.now(timezone.utc)
+    try:
+        await db.idempotency_keys.insert_one({
+            "id": record_id,
+            "request_hash": request_hash,
+            "status": "in_progress",
+            "created_at": now,
+            "updated_at": now
+        })
+    except DuplicateKeyError:
+        return await replay_idempotent(record_id, request_hash, operation, after, transactional)
+    return await complete_idempotent(record_id, operation, after, transactional)
+
+async def after_write(after, result):
+    """Run the follow-up of a committed write, logging rather than raising failures"""
+    if after is None:
+        return
+    try:
+        await after(result)
+    except Exception as e:
+        logger.error(f"Follow-up after a committed write failed: {e}")
+
+async def complete_idempotent(record_id: str, operation, after=None, transactional: bool = False):
+    """Run the operation for a claimed key and record its outcome"""
+    async def run(session):
+        result = await operation(session)
+        await db.idempotency_keys.update_one(
+            {"id": record_id},
+            {"$set": {"status": "completed", "status_code": 200, "response": jsonable_encoder(result)}},
+            session=session
+        )
+        return result
+    
+    try:
+        result = await (run_transaction(run) if transactional else run(None))
+    except HTTPException as e:
+        await db.idempotency_keys.update_one(
+            {"id": record_id},
+            {"$set": {"status": "completed", "status_code": e.status_code, "response": jsonable_encoder(e.detail)}}
+        )
+        raise
+    except BaseException:
+        # Nothing useful to replay; let a retry run the request again
+        await db.idempotency_keys.delete_one({"id": record_id})
+        raise
+    await after_write(after, result)
+    return result
+
+async def replay_idempotent(record_id: str, request_hash: str, operation, after=None, transactional: bool = False):
+    """Answer a duplicate with the stored outcome, waiting for it if needed"""
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        record = await db.idempotency_keys.find_one({"id": record_id}, {"_id": 0})
+        if record is None:
+            # The first attempt failed and released the key
+            raise HTTPException(status_code=409, detail="The original request failed; retry with the same Idempotency-Key")
+        if record['request_hash'] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if record['status'] == "completed":
+            if record['status_code'] != 200:
+                raise HTTPException(status_code=record['status_code'], detail=record['response'])
+            return record['response']
+        
+        stale = datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+        taken_over = await db.idempotency_keys.find_one_and_update(
+            {"id": record_id, "status": "in_progress", "updated_at": {"$lt": stale}},
+            {"$set": {"updated_at": datetime.now(timezone.utc)}}
+        )
+        if taken_over:
+            return await complete_idempotent(record_id, operation, after, transactional)
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(0.1)
+
+
+# ============= PRODUCT SEARCH =============
+
+# collection -> result type
+SEARCH_SOURCES = {"products": "product", "product_sets": "set"}
+
+class SearchIndex:
+    """In-memory name index over products and sets for typeahead search.
+
+    Names are case-folded and indexed by every trigram, plus the first one
+    and two characters of each word so that very short queries still match
+    word starts. A longer query intersects the sets of its trigrams and
+    confirms the substring on the few candidates left.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.grams = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    @staticmethod
+    def _grams(name: str) -> set:
+        grams = {name[i:i + 3] for i in range(len(name) - 2)}
+        for word in name.split():
+            grams.update((word[:1], word[:2]))
+        return grams
+
+    def add(self, kind: str, doc_id: str, name: str):
+        self.remove(kind, doc_id)
+        name = self.normalize(name)
+        self.names[(kind, doc_id)] = name
+        for gram in self._grams(name):
+            self.grams.setdefault(gram, set()).add((kind, doc_id))
+
+    def remove(self, kind: str, doc_id: str):
+        name = self.names.pop((kind, doc_id), None)
+        if name is None:
+            return
+        for gram in self._grams(name):
+            keys = self.grams.get(gram)
+            if keys is not None:
+                keys.discard((kind, doc_id))
+                if not keys:
+                    del self.grams[gram]
+
+    def search(self, query: str, limit: int) -> List[tuple]:
+        """Best (kind, id) matches: name prefix first, then word prefix, then substring"""
+        query = self.normalize(query)
+        if not query:
+            return []
+        if len(query) < 3:
+            candidates = self.grams.get(query, set())
+        else:
+            postings = sorted(
+                (self.grams.get(query[i:i + 3], set()) for i in range(len(query) - 2)),
+                key=len
+            )
+            candidates = set.intersection(*postings) if postings[0] else set()
+        
+        def rank(key):
+            name = self.names[key]
+            if name.startswith(query):
+                return (0, name)
+            if f" {query}" in name:
+                return (1, name)
+            return (2, name)
+        return heapq.nsmallest(limit, (key for key in candidates if query in self.names[key]), key=rank)
+
+    async def rebuild(self):
+        """Reload every product and set name"""
+        index = SearchIndex()
+        for collection, kind in SEARCH_SOURCES.items():
+            async for doc in db[collection].find({}, {"_id": 0, "id": 1, "name": 1}):
+                index.add(kind, doc['id'], doc['name'])
+        self.names, self.grams = index.names, index.grams
+
+search_index = SearchIndex()
+
+
+# ============= LIVE EVENTS =============
+
+# Events a slow client may have queued before it is sent a reset instead
+EVENT_QUEUE_SIZE = 256
+# Seconds between keep-alive comments on an idle stream
+EVENT_HEARTBEAT = 15
+# Size of the capped collection that relays events between workers
+EVENT_LOG_BYTES = 8 * 1024 * 1024
+
+class EventBus:
+    """Fans out small change events to the SSE clients of this worker.
+
+    Each client has a bounded queue and publishing never waits on it. A
+    client that falls behind and fills its queue has the backlog replaced by
+    a single "reset" event, after which it should refetch.
+
+    With a single worker (CACHE_SYNC=off) events go straight to the queues.
+    Otherwise they are appended to the capped event_log collection, which
+    every worker tails, so clients see writes handled by any worker. Workers
+    with clients announce themselves there every EVENT_HEARTBEAT seconds;
+    a worker that has heard no announcement does not publish at all.
+    """
+
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.sequence = 0
+        self.published = 0
+        self.resets = 0
+        self.worker_id = WORKER_ID
+        # When another worker last announced connected clients
+        self.remote_seen = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    @property
+    def relayed(self) -> bool:
+        return cache_sync.mode != "off"
+
+    def has_listeners(self) -> bool:
+        """True when a client is connected here or, recently, to another worker"""
+        if self.subscribers:
+            return True
+        return (
+            self.relayed and self.remote_seen is not None
+            and time.monotonic() - self.remote_seen < 2 * EVENT_HEARTBEAT
+        )
+
+    async def create_log(self):
+        """Create the capped event_log; an uncapped one cannot be tailed"""
+        try:
+            await db.create_collection("event_log", capped=True, size=EVENT_LOG_BYTES)
+        except CollectionInvalid:
+            if not (await db.event_log.options()).get('capped'):
+                await db.command("convertToCapped", "event_log", size=EVENT_LOG_BYTES)
+
+    async def announce(self):
+        """Tell the other workers this one has clients, so they publish their writes"""
+        if self.relayed and self.subscribers:
+            await db.event_log.insert_one({"presence": self.worker_id})
+
+    async def presence_loop(self):
+        while True:
+            await asyncio.sleep(EVENT_HEARTBEAT)
+            try:
+                await self.announce()
+            except Exception as e:
+                logger.error(f"Event presence announcement failed: {e}")
+
+    async def publish(self, events: List[tuple]):
+        """Send (type, data) events to every client of every worker"""
+        if not events:
+            return
+        if self.relayed:
+            await db.event_log.insert_one({"events": [[event_type, jsonable_encoder(data)] for event_type, data in events]})
+        else:
+            self.deliver(events)
+
+    def deliver(self, events: List[tuple]):
+        """Queue events for the clients connected to this worker"""
+        for event_type, data in events:
+            self.sequence += 1
+            self.published += 1
+            message = (self.sequence, event_type, data)
+            for queue in self.subscribers:
+                try:
+                    queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait((self.sequence, "reset", {}))
+                    self.resets += 1
+
+    async def relay_loop(self):
+        """Tail event_log and deliver what any worker publishes"""
+        newest = await db.event_log.find_one({}, sort=[("$natural", DESCENDING)])
+        last_id = newest['_id'] if newest else None
+        while True:
+            try:
+                query = {"_id": {"$gt": last_id}} if last_id else {}
+                cursor = db.event_log.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        last_id = doc['_id']
+                        if 'presence' in doc:
+                            if doc['presence'] != self.worker_id:
+                                self.remote_seen = time.monotonic()
+                            continue
+                        self.deliver([tuple(event) for event in doc['events']])
+                    await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Event relay failed, restarting: {e}")
+                # Events may have been missed; clients should refetch
+                self.deliver([("reset", {})])
+            # An empty capped collection ends the cursor straight away
+            await asyncio.sleep(0.5)
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.subscribers),
+            "relayed": self.relayed,
+            "remote_listeners": self.relayed and self.has_listeners() and not self.subscribers,
+            "published": self.published,
+            "resets": self.resets
+        }
+
+event_bus = EventBus()
+
+# Publishes still running; holding them keeps them from being collected
+publish_tasks = set()
+
+def publish_changes(balance: bool = False, product_ids=(), items: List[dict] = (), events: List[tuple] = ()):
+    """Publish what a committed write changed, in the background.
+
+    Sends the current balance when `balance` is set, the current quantity of
+    each of `product_ids` and of every product the sale/return `items` move,
+    and any extra (type, data) events. Nothing is read or written while no
+    worker has a client connected, and a failure is only logged: the write
+    it reports on has already committed.
+    """
+    if not event_bus.has_listeners():
+        return
+    task = asyncio.create_task(send_changes(balance, product_ids, items, events))
+    publish_tasks.add(task)
+    task.add_done_callback(publish_tasks.discard)
+
+async def send_changes(balance: bool, product_ids, items: List[dict], events: List[tuple]):
+    """Read the current values publish_changes was asked for and publish them"""
+    try:
+        messages = list(events)
+        product_ids = set(product_ids)
+        if items:
+            products, _ = await load_items_catalog(items)
+            product_ids.update(products)
+        if balance:
+            current = await get_or_create_balance()
+            messages.append(("balance", {"cash": current.get('cash', 0.0), "gpay": current.get('gpay', 0.0)}))
+        if product_ids:
+            async for product in db.products.find({"id": {"$in": list(product_ids)}}, {"_id": 0, "id": 1, "quantity": 1}):
+                messages.append(("product_quantity", product))
+        await event_bus.publish(messages)
+    except Exception as e:
+        logger.error(f"Publishing change events failed: {e}")
+
+def sale_event(sale: Sale) -> tuple:
+    return ("sale_created", {
+        "id": sale.id,
+        "sale_type": sale.sale_type,
+        "total": sale.total,
+        "payment_method": sale.payment_method,
+        "date": sale.date
+    })
+
+@api_router.get("/events")
+async def stream_events(request: Request):
+    """Server-Sent Events stream of balance, stock, sale and expense changes.
+
+    Event types: balance, product_quantity, sale_created, expense_created,
+    expense_deleted, and reset when the client missed events and should
+    refetch. An idle stream carries a comment every EVENT_HEARTBEAT seconds.
+    """
+    queue = event_bus.subscribe()
+    await event_bus.announce()
+    
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    sequence, event_type, data = await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"id: {sequence}\nevent: {event_type}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
+        finally:
+            event_bus.unsubscribe(queue)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ============= DELTA SYNC =============
+
+# Collections a client can mirror through GET /sync
+SYNC_COLLECTIONS = [
+    "categories", "products", "product_sets", "expense_categories",
+    "sales", "expenses", "money_transfers", "returns"
+]
+# Tombstones are kept this long; an older token has to start a full sync
+SYNC_TOMBSTONE_DAYS = 30
+# A rev block still in flight after this many seconds is treated as
+# abandoned (the worker died between reserving and writing)
+REV_IN_FLIGHT_TIMEOUT = 30
+
+@asynccontextmanager
+async def revisions(count: int = 1, session=None):
+    """Reserve `count` consecutive revs and yield the first.
+
+    Inside a transaction the counter update orders commits by itself: a
+    second writer conflicts on the counter until the first commits. Without
+    one, the block stays listed as in flight until the writes made inside
+    the `async with` finish, and /sync never hands out a token past it.
+    """
+    stages = [{"$set": {"value": {"$add": [{"$ifNull": ["$value", 0]}, count]}}}]
+    if session is None:
+        stages.append({"$set": {"in_flight": {"$concatArrays": [
+            {"$ifNull": ["$in_flight", []]},
+            [{"rev": {"$subtract": ["$value", count - 1]}, "at": "$$NOW"}]
+        ]}}})
+    counter = await db.counters.find_one_and_update(
+        {"id": "rev"},
+        stages,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
     )
+    first = counter['value'] - count + 1
+    try:
+        yield first
+    finally:
+        if session is None:
+            stale = datetime.now(timezone.utc) - timedelta(seconds=REV_IN_FLIGHT_TIMEOUT)
+            await db.counters.update_one(
+                {"id": "rev"},
+                {"$pull": {"in_flight": {"$or": [{"rev": first}, {"at": {"$lt": stale}}]}}}
+            )
+
+async def settled_rev() -> int:
+    """Highest rev below which every write is visible"""
+    counter = await db.counters.find_one({"id": "rev"}, {"_id": 0})
+    if not counter:
+        return 0
+    stale = datetime.now(timezone.utc) - timedelta(seconds=REV_IN_FLIGHT_TIMEOUT)
+    in_flight = [entry['rev'] for entry in counter.get('in_flight', []) if as_utc(entry['at']) > stale]
+    return min(in_flight) - 1 if in_flight else counter['value']
+
+async def record_tombstone(collection: str, doc_id: str):
+    """Record a delete so clients mirroring `collection` drop the document"""
+    async with revisions() as rev:
+        await db.tombstones.update_one(
+            {"id": f"{collection}:{doc_id}"},
+            {"$set": {"collection": collection, "doc_id": doc_id, "rev": rev, "deleted_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+async def backfill_revs(batch_size: int = 500) -> int:
+    """Give a rev to documents written before revs existed. Cheap once done."""
+    stamped = 0
+    for name in SYNC_COLLECTIONS:
+        while True:
+            batch = await db[name].find({"rev": None}, {"_id": 1}).to_list(batch_size)
+            if not batch:
+                break
+            async with revisions(len(batch)) as first:
+                # Another worker may be stamping the same documents
+                await db[name].bulk_write(
+                    [UpdateOne({"_id": doc['_id'], "rev": None}, {"$set": {"rev": first + index}}) for index, doc in enumerate(batch)],
+                    ordered=False
+                )
+            stamped += len(batch)
+    if stamped:
+        logger.info(f"Assigned revs to {stamped} documents")
+    return stamped
+
+def encode_sync_token(rev: int) -> str:
+    raw = json.dumps([rev, datetime.now(timezone.utc).isoformat()]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_sync_token(token: str):
+    try:
+        rev, issued_at = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return int(rev), datetime.fromisoformat(issued_at)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+@api_router.get("/sync")
+async def sync_changes(since: Optional[str] = None, limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    """Documents written and deleted since `since`, oldest first.
+    
+    Without `since` every document is returned, which is how a client starts.
+    Keep calling with the returned token while `has_more` is set. A token
+    older than SYNC_TOMBSTONE_DAYS gets 410: deletes may have been forgotten,
+    so the client has to start over.
+    """
+    since_rev = 0
+    if since:
+        since_rev, issued_at = decode_sync_token(since)
+        if as_utc(issued_at) < datetime.now(timezone.utc) - timedelta(days=SYNC_TOMBSTONE_DAYS):
+            raise HTTPException(status_code=410, detail="Sync token expired, start a full sync")
+    upper = await settled_rev()
+    window = {"rev": {"$gt": since_rev, "$lte": upper}}
+    
+    # Each source is read in rev order up to `limit`; merging keeps the
+    # lowest revs overall, so whatever is cut off comes after the token
+    entries = []
+    for name in SYNC_COLLECTIONS:
+        async for doc in db[name].find(window, {"_id": 0}).sort("rev", ASCENDING).limit(limit):
+            entries.append((doc['rev'], name, doc['id'], from_storage(doc)))
+    if since:
+        async for tombstone in db.tombstones.find(window, {"_id": 0}).sort("rev", ASCENDING).limit(limit):
+            entries.append((tombstone['rev'], tombstone['collection'], tombstone['doc_id'], None))
+    entries.sort(key=lambda entry: entry[0])
+    
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    changes = {name: [] for name in SYNC_COLLECTIONS}
+    deleted = {name: [] for name in SYNC_COLLECTIONS}
+    for _, name, doc_id, doc in entries:
+        if doc is None:
+            deleted[name].append(doc_id)
+        else:
+            changes[name].append(doc)
+    return {
+        "token": encode_sync_token(entries[-1][0] if has_more else upper),
+        "has_more": has_more,
+        "changes": changes,
+        "deleted": deleted
+    }
 
 
 # ============= CATEGORY ROUTES =============
@@ -267,17 +2199,17 @@ async def update_balance(cash_change: float = 0, gpay_change: float = 0):
 @api_router.post("/categories", response_model=Category)
 async def create_category(input: CategoryCreate):
     category = Category(**input.model_dump())
-    doc = category.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.categories.insert_one(doc)
+    async with revisions() as rev:
+        category.rev = rev
+        doc = to_storage(category)
+        await db.categories.insert_one(doc)
     return category
 
 @api_router.get("/categories", response_model=List[Category])
 async def get_categories():
     categories = await db.categories.find({}, {"_id": 0}).to_list(1000)
     for cat in categories:
-        if isinstance(cat['created_at'], str):
-            cat['created_at'] = datetime.fromisoformat(cat['created_at'])
+        from_storage(cat)
     return categories
 
 @api_router.put("/categories/{category_id}", response_model=Category)
@@ -286,17 +2218,20 @@ async def update_category(category_id: str, input: CategoryUpdate):
     if not existing:
         raise HTTPException(status_code=404, detail="Category not found")
     
-    await db.categories.update_one({"id": category_id}, {"$set": {"name": input.name}})
+    async with revisions() as rev:
+        await db.categories.update_one({"id": category_id}, {"$set": {"name": input.name, "rev": rev}})
+    await catalog_cache.invalidate("categories", category_id)
     updated = await db.categories.find_one({"id": category_id}, {"_id": 0})
-    if isinstance(updated['created_at'], str):
-        updated['created_at'] = datetime.fromisoformat(updated['created_at'])
+    from_storage(updated)
     return updated
 
 @api_router.delete("/categories/{category_id}")
 async def delete_category(category_id: str):
     result = await db.categories.delete_one({"id": category_id})
+    await catalog_cache.invalidate("categories", category_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Category not found")
+    await record_tombstone("categories", category_id)
     return {"message": "Category deleted"}
 
 @api_router.get("/categories/{category_id}/products", response_model=List[Product])
@@ -304,10 +2239,7 @@ async def get_products_by_category(category_id: str):
     """Get all products in a specific category"""
     products = await db.products.find({"category_id": category_id}, {"_id": 0}).to_list(1000)
     for prod in products:
-        if isinstance(prod['created_at'], str):
-            prod['created_at'] = datetime.fromisoformat(prod['created_at'])
-        if isinstance(prod['updated_at'], str):
-            prod['updated_at'] = datetime.fromisoformat(prod['updated_at'])
+        from_storage(prod)
     return products
 
 
@@ -316,18 +2248,25 @@ async def get_products_by_category(category_id: str):
 @api_router.post("/products", response_model=Product)
 async def create_product(input: ProductCreate):
     # Get category name
-    category = await db.categories.find_one({"id": input.category_id}, {"_id": 0})
+    category = await catalog_cache.get("categories", input.category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
     
     product_dict = input.model_dump()
     product_dict['category_name'] = category['name']
     product = Product(**product_dict)
+    await check_product_codes(product_dict)
     
-    doc = product.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    await db.products.insert_one(doc)
+    try:
+        async with revisions() as rev:
+            product.rev = rev
+            doc = to_storage(product)
+            await db.products.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Another product already uses this SKU or barcode")
+    await apply_valuation_changes([(None, doc)])
+    await catalog_cache.invalidate("products", product.id)
+    search_index.add("product", product.id, product.name)
     
     # If supplier balance exists, record it
     if input.supplier_name and input.supplier_balance and input.supplier_balance > 0:
@@ -337,71 +2276,138 @@ async def create_product(input: ProductCreate):
             "product_name": product.name,
             "supplier_name": input.supplier_name,
             "balance": input.supplier_balance,
-            "created_at": datetime.now(timezone.utc).isoformat()
+            "created_at": datetime.now(timezone.utc)
         }
         await db.supplier_balances.insert_one(supplier_record)
     
     return product
 
-@api_router.get("/products", response_model=List[Product])
-async def get_products():
-    products = await db.products.find({}, {"_id": 0}).to_list(1000)
-    for prod in products:
-        if isinstance(prod['created_at'], str):
-            prod['created_at'] = datetime.fromisoformat(prod['created_at'])
-        if isinstance(prod['updated_at'], str):
-            prod['updated_at'] = datetime.fromisoformat(prod['updated_at'])
-    return products
+@api_router.get("/products", response_model=Union[Page[Product], List[Product]])
+async def get_products(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    category_id: Optional[str] = None
+):
+    """List products; pass `limit`/`after` to page newest first"""
+    query = list_query("created_at", from_date, to_date, category_id=category_id)
+    return await list_documents(db.products, query, "created_at", limit, after, 1000)
+
+async def check_product_codes(fields: dict, product_id: Optional[str] = None):
+    """Reject a SKU or barcode that another product already uses in either field.
+
+    The unique indexes only cover each field on its own, and a code lookup
+    must resolve to one product whichever field it is stored in.
+    """
+    codes = [fields[field] for field in ("sku", "barcode") if fields.get(field)]
+    if not codes:
+        return
+    clash = await db.products.find_one(
+        {"id": {"$ne": product_id}, "$or": [{"sku": {"$in": codes}}, {"barcode": {"$in": codes}}]},
+        {"_id": 1}
+    )
+    if clash:
+        raise HTTPException(status_code=409, detail="Another product already uses this SKU or barcode")
+
+async def invalidate_product_codes(*products: dict):
+    """Drop cached code lookups for every SKU and barcode the given documents carry"""
+    for product in products:
+        for field in ("sku", "barcode"):
+            if product.get(field):
+                await catalog_cache.invalidate("product_codes", product[field])
+
+@api_router.get("/products/by-code/{code}")
+async def get_product_by_code(code: str):
+    """Resolve a scanned SKU or barcode to the product's name and prices.
+
+    Served from the catalog cache, so it carries no quantity.
+    """
+    product = await catalog_cache.get("product_codes", code)
+    if not product:
+        raise HTTPException(status_code=404, detail="No product with this SKU or barcode")
+    return product
+
+@api_router.get("/products/search")
+async def search_products(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100)):
+    """Typeahead over product and set names, case-insensitive.
+
+    Matching runs on the in-memory index; only the returned page is read
+    from the database, so quantities and prices are current.
+    """
+    matches = search_index.search(q, limit)
+    wanted = {kind: [doc_id for match_kind, doc_id in matches if match_kind == kind] for kind in SEARCH_SOURCES.values()}
+    found = {}
+    for collection, kind in SEARCH_SOURCES.items():
+        if wanted[kind]:
+            async for doc in db[collection].find({"id": {"$in": wanted[kind]}}, {"_id": 0}):
+                found[(kind, doc['id'])] = from_storage(doc)
+    return [{"type": kind, **found[(kind, doc_id)]} for kind, doc_id in matches if (kind, doc_id) in found]
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
     product = await db.products.find_one({"id": product_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    if isinstance(product['created_at'], str):
-        product['created_at'] = datetime.fromisoformat(product['created_at'])
-    if isinstance(product['updated_at'], str):
-        product['updated_at'] = datetime.fromisoformat(product['updated_at'])
+    from_storage(product)
     return product
 
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, input: ProductUpdate):
-    existing = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
     update_data = input.model_dump(exclude_unset=True)
     
     # Update category name if category_id changed
     if 'category_id' in update_data:
-        category = await db.categories.find_one({"id": update_data['category_id']}, {"_id": 0})
+        category = await catalog_cache.get("categories", update_data['category_id'])
         if not category:
             raise HTTPException(status_code=404, detail="Category not found")
         update_data['category_name'] = category['name']
     
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
-    
-    await db.products.update_one({"id": product_id}, {"$set": update_data})
+    await check_product_codes(update_data, product_id)
+    update_data['updated_at'] = datetime.now(timezone.utc)
     
-    updated = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if isinstance(updated['created_at'], str):
-        updated['created_at'] = datetime.fromisoformat(updated['created_at'])
-    if isinstance(updated['updated_at'], str):
-        updated['updated_at'] = datetime.fromisoformat(updated['updated_at'])
+    try:
+        async with revisions() as rev:
+            update_data['rev'] = rev
+            existing = await db.products.find_one_and_update(
+                {"id": product_id},
+                {"$set": update_data},
+                projection={"_id": 0},
+                return_document=ReturnDocument.BEFORE
+            )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Another product already uses this SKU or barcode")
+    if not existing:
+        raise HTTPException(status_code=404, detail="Product not found")
+    await catalog_cache.invalidate("products", product_id)
+    await invalidate_product_codes(existing, update_data)
+    updated = {**existing, **update_data}
+    search_index.add("product", product_id, updated['name'])
+    if 'quantity' in update_data:
+        publish_changes(product_ids=[product_id])
+    await apply_valuation_changes([(existing, updated)])
+    
+    from_storage(updated)
     return updated
 
 @api_router.post("/products/{product_id}/restock")
 async def restock_product(product_id: str, input: RestockProduct):
     """Restock a product with supplier information"""
-    existing = await db.products.find_one({"id": product_id}, {"_id": 0})
+    new_quantity = await run_transaction(lambda session: record_restock(product_id, input, session))
+    await catalog_cache.invalidate("products", product_id)
+    publish_changes(balance=input.paid_amount > 0, product_ids=[product_id])
+    if input.cost_price is not None:
+        await invalidate_product_codes(await db.products.find_one({"id": product_id}, {"_id": 0, "sku": 1, "barcode": 1}) or {})
+    return {"message": "Product restocked successfully", "new_quantity": new_quantity}
+
+async def record_restock(product_id: str, input: RestockProduct, session=None) -> float:
+    """Apply a restock and its payment, returning the new product quantity"""
+    existing = await db.products.find_one({"id": product_id}, {"_id": 0}, session=session)
     if not existing:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    new_quantity = existing['quantity'] + input.quantity
-    update_data = {
-        "quantity": new_quantity,
-        "updated_at": datetime.now(timezone.utc).isoformat()
-    }
+    update_data = {"updated_at": datetime.now(timezone.utc)}
+    increments = {"quantity": input.quantity}
     
     if input.cost_price is not None:
         update_data['cost_price'] = input.cost_price
@@ -411,9 +2417,21 @@ async def restock_product(product_id: str, input: RestockProduct):
         total_cost = (input.cost_price or existing['cost_price']) * input.quantity
         balance = total_cost - input.paid_amount
         if balance > 0:
-            update_data['supplier_balance'] = existing.get('supplier_balance', 0) + balance
-    
-    await db.products.update_one({"id": product_id}, {"$set": update_data})
+            increments['supplier_balance'] = balance
+    
+    async with revisions(session=session) as rev:
+        update_data['rev'] = rev
+        updated = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$inc": increments, "$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Product not found")
+    before = {**existing, "quantity": updated['quantity'] - input.quantity}
+    await apply_valuation_changes([(before, updated)], session)
     
     # Record stock transaction
     stock_transaction = {
@@ -426,39 +2444,96 @@ async def restock_product(product_id: str, input: RestockProduct):
         "paid_amount": input.paid_amount,
         "balance": (input.cost_price or existing['cost_price']) * input.quantity - input.paid_amount if input.supplier_name else 0,
         "payment_source": input.payment_source,
-        "date": datetime.now(timezone.utc).isoformat()
+        "date": datetime.now(timezone.utc)
     }
-    await db.stock_transactions.insert_one(stock_transaction)
+    await db.stock_transactions.insert_one(stock_transaction, session=session)
     
     # Update cash/gpay balance
     if input.paid_amount > 0:
         if input.payment_source == "cash":
-            await update_balance(cash_change=-input.paid_amount)
+            await update_balance(cash_change=-input.paid_amount, session=session)
         else:
-            await update_balance(gpay_change=-input.paid_amount)
+            await update_balance(gpay_change=-input.paid_amount, session=session)
     
-    return {"message": "Product restocked successfully", "new_quantity": new_quantity}
+    return updated['quantity']
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+    product = await db.products.find_one_and_delete({"id": product_id}, {"_id": 0})
+    await catalog_cache.invalidate("products", product_id)
+    if product:
+        await invalidate_product_codes(product)
+    search_index.remove("product", product_id)
+    if not product:
         raise HTTPException(status_code=404, detail="Product not found")
+    await record_tombstone("products", product_id)
+    await apply_valuation_changes([(product, None)])
     return {"message": "Product deleted"}
 
 @api_router.get("/inventory/total-value")
-async def get_inventory_total_value():
-    """Calculate total value of all inventory"""
-    products = await db.products.find({}, {"_id": 0}).to_list(10000)
-    total_cost = sum(p['cost_price'] * p['quantity'] for p in products)
-    total_retail = sum(p['retail_price'] * p['quantity'] for p in products)
-    total_wholesale = sum(p['wholesale_price'] * p['quantity'] for p in products)
+async def get_inventory_total_value(category_id: Optional[str] = None):
+    """Total value of all inventory, or of one category, from the running totals"""
+    key = f"category:{category_id}" if category_id else "overall"
+    valuation = await db.inventory_valuation.find_one({"id": key}, {"_id": 0}) or {}
     
     return {
-        "total_cost_value": total_cost,
-        "total_retail_value": total_retail,
-        "total_wholesale_value": total_wholesale,
-        "total_items": len(products)
+        "total_cost_value": valuation.get('cost_value', 0),
+        "total_retail_value": valuation.get('retail_value', 0),
+        "total_wholesale_value": valuation.get('wholesale_value', 0),
+        "total_items": valuation.get('items', 0)
+    }
+
+PRODUCT_UNITS = get_args(Product.model_fields['unit'].annotation)
+
+@api_router.get("/inventory/summary")
+async def get_inventory_summary(low_stock_threshold: float = Query(10, ge=0)):
+    """Per-category SKU counts, quantities, values and stock health"""
+    pipeline = [
+        {"$project": {
+            "_id": 0, "category_id": 1, "category_name": 1, "unit": 1, "quantity": 1,
+            "cost_price": 1, "retail_price": 1, "wholesale_price": 1
+        }},
+        {"$group": {
+            "_id": "$category_id",
+            "category_name": {"$first": "$category_name"},
+            "sku_count": {"$sum": 1},
+            **{
+                f"quantity_{unit}": {"$sum": {"$cond": [{"$eq": ["$unit", unit]}, "$quantity", 0]}}
+                for unit in PRODUCT_UNITS
+            },
+            **{
+                field: {"$sum": {"$multiply": [f"${price}", "$quantity"]}}
+                for field, price in VALUATION_FIELDS.items()
+            },
+            "out_of_stock": {"$sum": {"$cond": [{"$lte": ["$quantity", 0]}, 1, 0]}},
+            "low_stock": {"$sum": {"$cond": [
+                {"$and": [{"$gt": ["$quantity", 0]}, {"$lte": ["$quantity", low_stock_threshold]}]}, 1, 0
+            ]}}
+        }},
+        {"$sort": {"category_name": 1}}
+    ]
+    rows = await db.products.aggregate(pipeline).to_list(None)
+    
+    counters = ["sku_count", "out_of_stock", "low_stock"] + list(VALUATION_FIELDS)
+    totals = {field: 0 for field in counters}
+    totals['quantity_by_unit'] = {unit: 0 for unit in PRODUCT_UNITS}
+    categories = []
+    for row in rows:
+        quantity_by_unit = {unit: row.pop(f"quantity_{unit}") for unit in PRODUCT_UNITS}
+        for field in counters:
+            totals[field] += row[field]
+        for unit, quantity in quantity_by_unit.items():
+            totals['quantity_by_unit'][unit] += quantity
+        categories.append({
+            "category_id": row.pop('_id'),
+            **row,
+            "quantity_by_unit": quantity_by_unit
+        })
+    
+    return {
+        "low_stock_threshold": low_stock_threshold,
+        "categories": categories,
+        "totals": totals
     }
 
 
@@ -467,39 +2542,47 @@ async def get_inventory_total_value():
 @api_router.post("/sets", response_model=ProductSet)
 async def create_set(input: ProductSetCreate):
     # Verify all products exist
+    products = await catalog_cache.get_many("products", [item.product_id for item in input.items])
     for item in input.items:
-        product = await db.products.find_one({"id": item.product_id}, {"_id": 0})
-        if not product:
+        if item.product_id not in products:
             raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
     
     product_set = ProductSet(**input.model_dump())
-    doc = product_set.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.product_sets.insert_one(doc)
+    async with revisions() as rev:
+        product_set.rev = rev
+        doc = to_storage(product_set)
+        await db.product_sets.insert_one(doc)
+    await catalog_cache.invalidate("product_sets", product_set.id)
+    search_index.add("set", product_set.id, product_set.name)
     return product_set
 
-@api_router.get("/sets", response_model=List[ProductSet])
-async def get_sets():
-    sets = await db.product_sets.find({}, {"_id": 0}).to_list(1000)
-    for s in sets:
-        if isinstance(s['created_at'], str):
-            s['created_at'] = datetime.fromisoformat(s['created_at'])
-    return sets
+@api_router.get("/sets", response_model=Union[Page[ProductSet], List[ProductSet]])
+async def get_sets(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None
+):
+    """List product sets; pass `limit`/`after` to page newest first"""
+    query = list_query("created_at", from_date, to_date)
+    return await list_documents(db.product_sets, query, "created_at", limit, after, 1000)
 
 @api_router.get("/sets/{set_id}", response_model=ProductSet)
 async def get_set(set_id: str):
     product_set = await db.product_sets.find_one({"id": set_id}, {"_id": 0})
     if not product_set:
         raise HTTPException(status_code=404, detail="Set not found")
-    if isinstance(product_set['created_at'], str):
-        product_set['created_at'] = datetime.fromisoformat(product_set['created_at'])
+    from_storage(product_set)
     return product_set
 
 @api_router.delete("/sets/{set_id}")
 async def delete_set(set_id: str):
     result = await db.product_sets.delete_one({"id": set_id})
+    await catalog_cache.invalidate("product_sets", set_id)
+    search_index.remove("set", set_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Set not found")
+    await record_tombstone("product_sets", set_id)
     return {"message": "Set deleted"}
 
 
@@ -508,17 +2591,17 @@ async def delete_set(set_id: str):
 @api_router.post("/expense-categories", response_model=ExpenseCategory)
 async def create_expense_category(input: ExpenseCategoryCreate):
     category = ExpenseCategory(**input.model_dump())
-    doc = category.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.expense_categories.insert_one(doc)
+    async with revisions() as rev:
+        category.rev = rev
+        doc = to_storage(category)
+        await db.expense_categories.insert_one(doc)
     return category
 
 @api_router.get("/expense-categories", response_model=List[ExpenseCategory])
 async def get_expense_categories():
     categories = await db.expense_categories.find({}, {"_id": 0}).to_list(1000)
     for cat in categories:
-        if isinstance(cat['created_at'], str):
-            cat['created_at'] = datetime.fromisoformat(cat['created_at'])
+        from_storage(cat)
     return categories
 
 @api_router.put("/expense-categories/{category_id}", response_model=ExpenseCategory)
@@ -527,38 +2610,35 @@ async def update_expense_category(category_id: str, input: ExpenseCategoryUpdate
     if not existing:
         raise HTTPException(status_code=404, detail="Expense category not found")
     
-    await db.expense_categories.update_one({"id": category_id}, {"$set": {"name": input.name}})
+    async with revisions() as rev:
+        await db.expense_categories.update_one({"id": category_id}, {"$set": {"name": input.name, "rev": rev}})
+    await catalog_cache.invalidate("expense_categories", category_id)
     updated = await db.expense_categories.find_one({"id": category_id}, {"_id": 0})
-    if isinstance(updated['created_at'], str):
-        updated['created_at'] = datetime.fromisoformat(updated['created_at'])
+    from_storage(updated)
     return updated
 
 @api_router.delete("/expense-categories/{category_id}")
 async def delete_expense_category(category_id: str):
     result = await db.expense_categories.delete_one({"id": category_id})
+    await catalog_cache.invalidate("expense_categories", category_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Expense category not found")
+    await record_tombstone("expense_categories", category_id)
     return {"message": "Expense category deleted"}
 
 
 # ============= EXPENSE ROUTES =============
 
 @api_router.post("/expenses", response_model=Expense)
-async def create_expense(input: ExpenseCreate):
+async def create_expense(input: ExpenseCreate, idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent("expenses", idempotency_key, input, lambda session: save_expense(input), expense_saved)
+
+async def save_expense(input: ExpenseCreate) -> Expense:
     # Get category name
-    category = await db.expense_categories.find_one({"id": input.category_id}, {"_id": 0})
+    category = await catalog_cache.get("expense_categories", input.category_id)
     if not category:
         raise HTTPException(status_code=404, detail="Expense category not found")
     
-    # Check if there's sufficient balance
-    balance = await get_or_create_balance()
-    if input.payment_source == "cash":
-        if balance['cash'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient cash balance. Available: ₹{balance['cash']:.2f}, Required: ₹{input.amount:.2f}")
-    else:  # gpay
-        if balance['gpay'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient GPay balance. Available: ₹{balance['gpay']:.2f}, Required: ₹{input.amount:.2f}")
-    
     expense_dict = input.model_dump()
     expense_dict['category_name'] = category['name']
     
@@ -567,28 +2647,50 @@ async def create_expense(input: ExpenseCreate):
     
     expense = Expense(**expense_dict)
     
-    doc = expense.model_dump()
-    doc['date'] = doc['date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.expenses.insert_one(doc)
-    
-    # Update balance based on payment source
+    # Check and debit the balance in one atomic update
     if input.payment_source == "cash":
-        await update_balance(cash_change=-input.amount)
-    else:
-        await update_balance(gpay_change=-input.amount)
+        await debit_balance("cash", input.amount, "Insufficient cash balance", cash_change=-input.amount)
+    else:  # gpay
+        await debit_balance("gpay", input.amount, "Insufficient GPay balance", gpay_change=-input.amount)
+    
+    try:
+        async with revisions() as rev:
+            expense.rev = rev
+            doc = to_storage(expense)
+            await db.expenses.insert_one(doc)
+    except Exception:
+        # Give the money back if the expense could not be recorded
+        if input.payment_source == "cash":
+            await update_balance(cash_change=input.amount)
+        else:
+            await update_balance(gpay_change=input.amount)
+        raise
+    await bump_rollup(expense.date, expense_rollup(doc), expense_category_name(doc))
     
     return expense
 
-@api_router.get("/expenses", response_model=List[Expense])
-async def get_expenses():
-    expenses = await db.expenses.find({}, {"_id": 0}).to_list(10000)
-    for exp in expenses:
-        if isinstance(exp['date'], str):
-            exp['date'] = datetime.fromisoformat(exp['date'])
-        if isinstance(exp['created_at'], str):
-            exp['created_at'] = datetime.fromisoformat(exp['created_at'])
-    return expenses
+async def expense_saved(expense: Expense):
+    await report_cache.invalidate_date(expense.date)
+    publish_changes(balance=True, events=[("expense_created", {
+        "id": expense.id,
+        "category_name": expense.category_name,
+        "amount": expense.amount,
+        "payment_source": expense.payment_source,
+        "date": expense.date
+    })])
+
+@api_router.get("/expenses", response_model=Union[Page[Expense], List[Expense]])
+async def get_expenses(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    category_id: Optional[str] = None,
+    payment_source: Optional[Literal["cash", "gpay"]] = None
+):
+    """List expenses; pass `limit`/`after` to page newest first"""
+    query = list_query("date", from_date, to_date, category_id=category_id, payment_source=payment_source)
+    return await list_documents(db.expenses, query, "date", limit, after, 10000)
 
 @api_router.get("/expenses/daily/{date}")
 async def get_daily_expenses(date: str):
@@ -598,69 +2700,45 @@ async def get_daily_expenses(date: str):
         if target_date.tzinfo is None:
             target_date = target_date.replace(tzinfo=timezone.utc)
         start = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = target_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+        end = start + timedelta(days=1)
     except:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
     
-    expenses = await db.expenses.find({}, {"_id": 0}).to_list(10000)
-    filtered_expenses = []
-    for exp in expenses:
-        if isinstance(exp['date'], str):
-            exp_date = datetime.fromisoformat(exp['date'])
-        else:
-            exp_date = exp['date']
-        if exp_date.tzinfo is None:
-            exp_date = exp_date.replace(tzinfo=timezone.utc)
-        if start <= exp_date <= end:
-            filtered_expenses.append(exp)
-    
-    return filtered_expenses
+    expenses = await db.expenses.find(date_range_match("date", start, end), {"_id": 0}).to_list(None)
+    return [from_storage(exp) for exp in expenses]
 
 @api_router.delete("/expenses/{expense_id}")
 async def delete_expense(expense_id: str):
-    expense = await db.expenses.find_one({"id": expense_id}, {"_id": 0})
+    # Delete first so concurrent deletes cannot restore the balance twice
+    expense = await db.expenses.find_one_and_delete({"id": expense_id}, {"_id": 0})
     if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
+    from_storage(expense)
     
     # Restore balance
     if expense.get('payment_source') == "cash":
         await update_balance(cash_change=expense['amount'])
     else:
         await update_balance(gpay_change=expense['amount'])
+    await bump_rollup(expense['date'], expense_rollup(expense, -1))
+    await report_cache.invalidate_date(expense['date'])
+    await record_tombstone("expenses", expense_id)
+    publish_changes(balance=True, events=[("expense_deleted", {"id": expense_id})])
     
-    result = await db.expenses.delete_one({"id": expense_id})
     return {"message": "Expense deleted"}
 
 
 # ============= MONEY TRANSFER ROUTES =============
 
 @api_router.post("/money-transfers", response_model=MoneyTransfer)
-async def create_money_transfer(input: MoneyTransferCreate):
-    # Check balance before transfer
-    balance = await get_or_create_balance()
-    
-    # Validate sufficient balance for operations that reduce balance
-    if input.transfer_type == "cash_to_gpay":
-        if balance['cash'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient cash balance. Available: ₹{balance['cash']:.2f}, Required: ₹{input.amount:.2f}")
-    elif input.transfer_type == "gpay_to_cash":
-        if balance['gpay'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient GPay balance. Available: ₹{balance['gpay']:.2f}, Required: ₹{input.amount:.2f}")
-    elif input.transfer_type == "customer_cash_to_gpay":
-        # Customer gives cash, we send GPay - need GPay balance
-        if balance['gpay'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient GPay balance to send to customer. Available: ₹{balance['gpay']:.2f}, Required: ₹{input.amount:.2f}")
-    elif input.transfer_type == "customer_gpay_to_cash":
-        # Customer sends GPay, we give cash - need cash balance
-        if balance['cash'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient cash balance to give to customer. Available: ₹{balance['cash']:.2f}, Required: ₹{input.amount:.2f}")
-    elif input.transfer_type == "cash_withdrawal":
-        if balance['cash'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient cash balance to withdraw. Available: ₹{balance['cash']:.2f}, Required: ₹{input.amount:.2f}")
-    elif input.transfer_type == "gpay_withdrawal":
-        if balance['gpay'] < input.amount:
-            raise HTTPException(status_code=400, detail=f"Insufficient GPay balance to withdraw. Available: ₹{balance['gpay']:.2f}, Required: ₹{input.amount:.2f}")
-    
+async def create_money_transfer(input: MoneyTransferCreate, idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent(
+        "money-transfers", idempotency_key, input, lambda session: save_money_transfer(input, session),
+        transfer_saved,
+        transactional=True
+    )
+
+async def save_money_transfer(input: MoneyTransferCreate, session=None) -> MoneyTransfer:
     transfer_dict = input.model_dump()
     
     if transfer_dict['date'] is None:
@@ -668,80 +2746,62 @@ async def create_money_transfer(input: MoneyTransferCreate):
     
     transfer = MoneyTransfer(**transfer_dict)
     
-    doc = transfer.model_dump()
-    doc['date'] = doc['date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.money_transfers.insert_one(doc)
-    
-    # Update balances based on transfer type
-    if input.transfer_type == "cash_to_gpay":
-        # Own money: Cash → GPay
-        await update_balance(cash_change=-input.amount, gpay_change=input.amount)
-    elif input.transfer_type == "gpay_to_cash":
-        # Own money: GPay → Cash
-        await update_balance(cash_change=input.amount, gpay_change=-input.amount)
-    elif input.transfer_type == "customer_cash_to_gpay":
-        # Customer gives cash, wants GPay from us (we receive cash, we send GPay)
-        await update_balance(cash_change=input.amount, gpay_change=-input.amount)
-    elif input.transfer_type == "customer_gpay_to_cash":
-        # Customer wants cash, will GPay us (we receive GPay, we give cash)
-        await update_balance(cash_change=-input.amount, gpay_change=input.amount)
-    elif input.transfer_type == "cash_withdrawal":
-        # Withdraw cash from business
-        await update_balance(cash_change=-input.amount)
-    elif input.transfer_type == "gpay_withdrawal":
-        # Withdraw GPay from business
-        await update_balance(gpay_change=-input.amount)
-    elif input.transfer_type == "cash_deposit":
-        # Deposit cash to business
-        await update_balance(cash_change=input.amount)
-    elif input.transfer_type == "gpay_deposit":
-        # Deposit GPay to business
-        await update_balance(gpay_change=input.amount)
+    # Update balances based on transfer type; operations that reduce a balance
+    # check for sufficient funds in the same atomic update
+    cash_sign, gpay_sign, message = TRANSFER_EFFECTS[input.transfer_type]
+    cash_change = cash_sign * input.amount
+    gpay_change = gpay_sign * input.amount
+    if cash_sign < 0:
+        await debit_balance("cash", input.amount, message, cash_change=cash_change, gpay_change=gpay_change, session=session)
+    elif gpay_sign < 0:
+        await debit_balance("gpay", input.amount, message, cash_change=cash_change, gpay_change=gpay_change, session=session)
+    else:
+        await update_balance(cash_change=cash_change, gpay_change=gpay_change, session=session)
+    
+    try:
+        async with revisions(session=session) as rev:
+            transfer.rev = rev
+            doc = to_storage(transfer)
+            await db.money_transfers.insert_one(doc, session=session)
+    except Exception:
+        # A transaction rolls the balance back by itself
+        if session is None:
+            await update_balance(cash_change=-cash_change, gpay_change=-gpay_change)
+        raise
+    await bump_rollup(transfer.date, transfer_rollup(doc), session=session)
     
     return transfer
 
-@api_router.get("/money-transfers", response_model=List[MoneyTransfer])
-async def get_money_transfers():
-    transfers = await db.money_transfers.find({}, {"_id": 0}).to_list(10000)
-    for transfer in transfers:
-        if isinstance(transfer['date'], str):
-            transfer['date'] = datetime.fromisoformat(transfer['date'])
-        if isinstance(transfer['created_at'], str):
-            transfer['created_at'] = datetime.fromisoformat(transfer['created_at'])
-    return transfers
+async def transfer_saved(transfer: MoneyTransfer):
+    publish_changes(balance=True)
+
+@api_router.get("/money-transfers", response_model=Union[Page[MoneyTransfer], List[MoneyTransfer]])
+async def get_money_transfers(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    transfer_type: Optional[str] = None
+):
+    """List money transfers; pass `limit`/`after` to page newest first"""
+    query = list_query("date", from_date, to_date, transfer_type=transfer_type)
+    return await list_documents(db.money_transfers, query, "date", limit, after, 10000)
 
 @api_router.delete("/money-transfers/{transfer_id}")
 async def delete_money_transfer(transfer_id: str):
-    transfer = await db.money_transfers.find_one({"id": transfer_id}, {"_id": 0})
+    # Delete first so concurrent deletes cannot reverse the transfer twice
+    transfer = await db.money_transfers.find_one_and_delete({"id": transfer_id}, {"_id": 0})
     if not transfer:
         raise HTTPException(status_code=404, detail="Transfer not found")
+    from_storage(transfer)
     
     # Reverse the transfer based on type
-    if transfer['transfer_type'] == "cash_to_gpay":
-        await update_balance(cash_change=transfer['amount'], gpay_change=-transfer['amount'])
-    elif transfer['transfer_type'] == "gpay_to_cash":
-        await update_balance(cash_change=-transfer['amount'], gpay_change=transfer['amount'])
-    elif transfer['transfer_type'] == "customer_cash_to_gpay":
-        # Reverse: we gave GPay, we received cash
-        await update_balance(cash_change=-transfer['amount'], gpay_change=transfer['amount'])
-    elif transfer['transfer_type'] == "customer_gpay_to_cash":
-        # Reverse: we gave cash, we received GPay
-        await update_balance(cash_change=transfer['amount'], gpay_change=-transfer['amount'])
-    elif transfer['transfer_type'] == "cash_withdrawal":
-        # Restore cash
-        await update_balance(cash_change=transfer['amount'])
-    elif transfer['transfer_type'] == "gpay_withdrawal":
-        # Restore GPay
-        await update_balance(gpay_change=transfer['amount'])
-    elif transfer['transfer_type'] == "cash_deposit":
-        # Reverse deposit (remove cash)
-        await update_balance(cash_change=-transfer['amount'])
-    elif transfer['transfer_type'] == "gpay_deposit":
-        # Reverse deposit (remove GPay)
-        await update_balance(gpay_change=-transfer['amount'])
-    
-    result = await db.money_transfers.delete_one({"id": transfer_id})
+    cash_sign, gpay_sign, _ = TRANSFER_EFFECTS[transfer['transfer_type']]
+    await update_balance(cash_change=-cash_sign * transfer['amount'], gpay_change=-gpay_sign * transfer['amount'])
+    await bump_rollup(transfer['date'], transfer_rollup(transfer, -1))
+    await record_tombstone("money_transfers", transfer_id)
+    publish_changes(balance=True)
+    
     return {"message": "Transfer deleted"}
 
 
@@ -756,7 +2816,107 @@ async def get_balance():
 # ============= SALE ROUTES =============
 
 @api_router.post("/sales", response_model=Sale)
-async def create_sale(input: SaleCreate):
+async def create_sale(input: SaleCreate, idempotency_key: Optional[str] = Header(None)):
+    async def saved(sale: Sale):
+        await report_cache.invalidate_date(sale.date)
+        publish_changes(
+            balance=True,
+            items=[item.model_dump() for item in sale.items],
+            events=[sale_event(sale)]
+        )
+    return await run_idempotent(
+        "sales", idempotency_key, input,
+        lambda session: record_sale(input, session),
+        saved,
+        transactional=True
+    )
+
+async def record_sale(input: SaleCreate, session=None) -> Sale:
+    """Write a sale and all of its stock, expense and balance effects"""
+    unknown = await resolve_item_codes([input], session)
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown product code: {', '.join(sorted(unknown))}")
+    problem = incomplete_items(input)
+    if problem:
+        raise HTTPException(status_code=422, detail=problem)
+    # Snapshot cost prices so reports never need to look products up again
+    products, sets = await load_items_catalog([item.model_dump() for item in input.items], session)
+    sale = price_sale(input, products, sets)
+    deltas = stock_deltas([item.model_dump() for item in sale.items], sets, -1)
+    gpay_return = bool(input.gpay_return and input.gpay_return > 0)
+    
+    # One rev block for the sale, then each product, then the GPay expense
+    async with revisions(1 + len(deltas) + gpay_return, session) as first:
+        # Insert first so a repeated client_id fails before any stock or money moves
+        try:
+            sale.rev = first
+            doc = to_storage(sale)
+            await db.sales.insert_one(doc, session=session)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail=f"A sale with client_id {input.client_id} already exists")
+        
+        # Update product quantities
+        await apply_stock_deltas(deltas, products, session, first + 1)
+        
+        # Handle GPay return as expense
+        if gpay_return:
+            expense = gpay_return_expense(sale, await gpay_returns_category(session))
+            expense.rev = first + 1 + len(deltas)
+            exp_doc = to_storage(expense)
+            await db.expenses.insert_one(exp_doc, session=session)
+    
+    if gpay_return:
+        await bump_rollup(expense.date, expense_rollup(exp_doc), expense_category_name(exp_doc), session=session)
+        
+        # Update balances
+        await update_balance(cash_change=-input.gpay_return, session=session)
+    
+    # Update cash/gpay balance based on payment
+    amount_received = sale.amount_paid
+    if input.payment_method == "cash":
+        await update_balance(cash_change=amount_received, session=session)
+    else:  # gpay
+        await update_balance(gpay_change=amount_received, session=session)
+    
+    await bump_rollup(sale.date, sale_rollup(doc), session=session)
+    return sale
+
+async def resolve_item_codes(sales: List[SaleCreate], session=None) -> set:
+    """Fill in items given only by code with one catalog lookup for all sales.
+
+    Name and unit price default from the product (retail or wholesale price
+    by sale type) and the total from the unit price. Returns the codes that
+    match no product.
+    """
+    coded = [
+        (sale, item) for sale in sales for item in sale.items
+        if item.code and not item.product_id and not item.set_id
+    ]
+    if not coded:
+        return set()
+    products = await catalog_cache.get_many("product_codes", [item.code for _, item in coded], session)
+    for sale, item in coded:
+        product = products.get(item.code)
+        if product is None:
+            continue
+        item.product_id = product['id']
+        if item.name is None:
+            item.name = product['name']
+        if item.unit_price is None:
+            item.unit_price = product[f"{sale.sale_type}_price"]
+    return {item.code for _, item in coded if item.code not in products}
+
+def incomplete_items(sale: SaleCreate) -> Optional[str]:
+    """Describe the first item still missing its name or price, if any"""
+    for index, item in enumerate(sale.items):
+        if item.total is None and item.unit_price is not None:
+            item.total = item.unit_price * item.quantity
+        if item.name is None or item.unit_price is None:
+            return f"Item {index + 1} needs a code or a name and unit price"
+    return None
+
+def price_sale(input: SaleCreate, products: dict, sets: dict) -> Sale:
+    """Build a sale with its totals, payment state and item cost snapshots"""
     # Calculate totals
     subtotal = sum(item.total for item in input.items)
     
@@ -783,92 +2943,195 @@ async def create_sale(input: SaleCreate):
     if sale_dict['date'] is None:
         sale_dict['date'] = datetime.now(timezone.utc)
     
-    sale = Sale(**sale_dict)
+    snapshot_item_costs(sale_dict['items'], products, sets)
+    return Sale(**sale_dict)
+
+async def gpay_returns_category(session=None) -> dict:
+    """Find the expense category for GPay returns, creating it on first use"""
+    expense_category = await db.expense_categories.find_one({"name": "GPay Returns"}, {"_id": 0}, session=session)
+    if not expense_category:
+        # Create GPay Returns category
+        gpay_cat = ExpenseCategory(name="GPay Returns")
+        async with revisions(session=session) as rev:
+            gpay_cat.rev = rev
+            doc = to_storage(gpay_cat)
+            await db.expense_categories.insert_one(doc, session=session)
+        expense_category = gpay_cat.model_dump()
+    return expense_category
+
+def gpay_return_expense(sale: Sale, expense_category: dict) -> Expense:
+    return Expense(
+        category_id=expense_category['id'],
+        category_name="GPay Returns",
+        amount=sale.gpay_return,
+        description=f"GPay return for sale {sale.id}",
+        payment_source="cash",
+        date=sale.date
+    )
+
+@api_router.post("/sales/batch")
+async def create_sale_batch(input: SaleBatch):
+    """Record queued offline sales in bulk, once per client_id.
+
+    Returns one result per submitted sale, in order: created, duplicate (a
+    sale with that client_id already exists) or rejected (it references an
+    unknown product or set).
+    """
+    try:
+        results, sales = await run_transaction(lambda session: record_sale_batch(input.sales, session))
+    except BulkWriteError:
+        # A concurrent request stored some of these client ids first and the
+        # transaction was rolled back; the retry reports them as duplicates
+        results, sales = await run_transaction(lambda session: record_sale_batch(input.sales, session))
+    for date in {day_start(sale.date) for sale in sales}:
+        await report_cache.invalidate_date(date)
+    if sales:
+        publish_changes(
+            balance=True,
+            items=[item.model_dump() for sale in sales for item in sale.items],
+            events=[sale_event(sale) for sale in sales]
+        )
+    return {
+        "results": results,
+        "created": len(sales),
+        "duplicates": sum(1 for result in results if result.status == "duplicate"),
+        "rejected": sum(1 for result in results if result.status == "rejected")
+    }
+
+async def record_sale_batch(inputs: List[BatchSaleCreate], session=None):
+    """Write many sales with one catalog lookup and bulk writes for their effects"""
+    results = [SaleBatchResult(client_id=sale_input.client_id, status="created") for sale_input in inputs]
+    existing = {
+        sale['client_id']: sale['id']
+        async for sale in db.sales.find(
+            {"client_id": {"$in": [sale_input.client_id for sale_input in inputs]}},
+            {"_id": 0, "id": 1, "client_id": 1},
+            session=session
+        )
+    }
+    unknown_codes = await resolve_item_codes(inputs, session)
+    products, sets = await load_items_catalog(
+        [item.model_dump() for sale_input in inputs for item in sale_input.items], session
+    )
     
-    # Update product quantities
-    for item in input.items:
-        if item.product_id:
-            product = await db.products.find_one({"id": item.product_id}, {"_id": 0})
-            if product:
-                new_quantity = product['quantity'] - item.quantity
-                await db.products.update_one(
-                    {"id": item.product_id},
-                    {"$set": {"quantity": new_quantity, "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-        elif item.set_id:
-            # Get set items and reduce stock
-            product_set = await db.product_sets.find_one({"id": item.set_id}, {"_id": 0})
-            if product_set:
-                for set_item in product_set['items']:
-                    product = await db.products.find_one({"id": set_item['product_id']}, {"_id": 0})
-                    if product:
-                        new_quantity = product['quantity'] - (set_item['quantity'] * item.quantity)
-                        await db.products.update_one(
-                            {"id": set_item['product_id']},
-                            {"$set": {"quantity": new_quantity, "updated_at": datetime.now(timezone.utc).isoformat()}}
-                        )
-    
-    # Handle GPay return as expense
-    if input.gpay_return and input.gpay_return > 0:
-        expense_category = await db.expense_categories.find_one({"name": "GPay Returns"}, {"_id": 0})
-        if not expense_category:
-            # Create GPay Returns category
-            gpay_cat = ExpenseCategory(name="GPay Returns")
-            doc = gpay_cat.model_dump()
-            doc['created_at'] = doc['created_at'].isoformat()
-            await db.expense_categories.insert_one(doc)
-            expense_category = gpay_cat.model_dump()
+    accepted = []
+    for result, sale_input in zip(results, inputs):
+        if result.client_id in existing:
+            result.status = "duplicate"
+            result.sale_id = existing[result.client_id]
+            continue
+        unknown = [
+            item.product_id or item.set_id or item.code for item in sale_input.items
+            if (item.product_id and item.product_id not in products)
+            or (not item.product_id and item.set_id and item.set_id not in sets)
+            or (not item.product_id and not item.set_id and item.code in unknown_codes)
+        ]
+        if unknown:
+            result.status = "rejected"
+            result.detail = f"Unknown product, set or code: {', '.join(unknown)}"
+            continue
+        problem = incomplete_items(sale_input)
+        if problem:
+            result.status = "rejected"
+            result.detail = problem
+            continue
+        sale = price_sale(sale_input, products, sets)
+        # Later copies of a client_id in the same batch are duplicates too
+        existing[result.client_id] = sale.id
+        result.sale_id = sale.id
+        accepted.append(sale)
+    
+    if not accepted:
+        return results, []
+    
+    # One rev block for the sales, then the products they stock, then their
+    # GPay expenses; sales rejected as duplicates on insert leave gaps
+    product_ids = {
+        product_id for sale in accepted
+        for product_id in stock_deltas([item.model_dump() for item in sale.items], sets, -1)
+    }
+    gpay_count = sum(1 for sale in accepted if sale.gpay_return and sale.gpay_return > 0)
+    product_rev = len(accepted)
+    gpay_rev = product_rev + len(product_ids)
+    async with revisions(gpay_rev + gpay_count, session) as first:
+        # Insert first: without transactions the unique client_id index is what
+        # stops a concurrent batch from applying the same sale twice
+        try:
+            for index, sale in enumerate(accepted):
+                sale.rev = first + index
+            docs = [to_storage(sale) for sale in accepted]
+            await db.sales.insert_many(docs, ordered=False, session=session)
+        except BulkWriteError as e:
+            if session is not None or any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+            failed = {error['index'] for error in e.details['writeErrors']}
+            for index in sorted(failed):
+                result = next(result for result in results if result.sale_id == accepted[index].id)
+                result.status = "duplicate"
+                result.sale_id = None
+            accepted = [sale for index, sale in enumerate(accepted) if index not in failed]
+            docs = [doc for index, doc in enumerate(docs) if index not in failed]
         
-        # Create expense entry
-        expense = Expense(
-            category_id=expense_category['id'],
-            category_name="GPay Returns",
-            amount=input.gpay_return,
-            description=f"GPay return for sale {sale.id}",
-            payment_source="cash",
-            date=sale.date
-        )
-        exp_doc = expense.model_dump()
-        exp_doc['date'] = exp_doc['date'].isoformat()
-        exp_doc['created_at'] = exp_doc['created_at'].isoformat()
-        await db.expenses.insert_one(exp_doc)
+        deltas = {}
+        cash_change = 0.0
+        gpay_change = 0.0
+        rollups = {}
         
-        # Update balances
-        await update_balance(cash_change=-input.gpay_return)
-    
-    # Update cash/gpay balance based on payment
-    amount_received = sale_dict['amount_paid']
-    if input.payment_method == "cash":
-        await update_balance(cash_change=amount_received)
-    else:  # gpay
-        await update_balance(gpay_change=amount_received)
-    
-    doc = sale.model_dump()
-    doc['date'] = doc['date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.sales.insert_one(doc)
-    return sale
-
-@api_router.get("/sales", response_model=List[Sale])
-async def get_sales():
-    sales = await db.sales.find({}, {"_id": 0}).to_list(10000)
-    for sale in sales:
-        if isinstance(sale['date'], str):
-            sale['date'] = datetime.fromisoformat(sale['date'])
-        if isinstance(sale['created_at'], str):
-            sale['created_at'] = datetime.fromisoformat(sale['created_at'])
-    return sales
+        def add_rollup(date, increments, names=None):
+            rollup = rollups.setdefault(day_key(date), {"date": date, "increments": {}, "names": {}})
+            for path, value in increments.items():
+                rollup['increments'][path] = rollup['increments'].get(path, 0) + value
+            rollup['names'].update(names or {})
+        
+        for sale, doc in zip(accepted, docs):
+            for product_id, delta in stock_deltas(doc['items'], sets, -1).items():
+                deltas[product_id] = deltas.get(product_id, 0) + delta
+            if sale.payment_method == "cash":
+                cash_change += sale.amount_paid
+            else:
+                gpay_change += sale.amount_paid
+            add_rollup(sale.date, sale_rollup(doc))
+        
+        gpay_sales = [sale for sale in accepted if sale.gpay_return and sale.gpay_return > 0]
+        if gpay_sales:
+            expense_category = await gpay_returns_category(session)
+            exp_docs = [
+                to_storage(gpay_return_expense(sale, expense_category).model_copy(update={"rev": first + gpay_rev + index}))
+                for index, sale in enumerate(gpay_sales)
+            ]
+            await db.expenses.insert_many(exp_docs, session=session)
+            for exp_doc in exp_docs:
+                cash_change -= exp_doc['amount']
+                add_rollup(exp_doc['date'], expense_rollup(exp_doc), expense_category_name(exp_doc))
+        
+        await apply_stock_deltas(deltas, products, session, first + product_rev)
+    await update_balance(cash_change=cash_change, gpay_change=gpay_change, session=session)
+    for rollup in rollups.values():
+        await bump_rollup(rollup['date'], rollup['increments'], rollup['names'], session=session)
+    return results, accepted
+
+@api_router.get("/sales", response_model=Union[Page[Sale], List[Sale]])
+async def get_sales(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    sale_type: Optional[Literal["retail", "wholesale"]] = None,
+    payment_type: Optional[Literal["full", "credit"]] = None
+):
+    """List sales; pass `limit`/`after` to page newest first"""
+    query = list_query("date", from_date, to_date, sale_type=sale_type, payment_type=payment_type)
+    return await list_documents(db.sales, query, "date", limit, after, 10000)
 
 @api_router.get("/sales/credit")
 async def get_credit_sales():
     """Get all credit sales with outstanding balance"""
-    sales = await db.sales.find({"payment_type": "credit"}, {"_id": 0}).to_list(10000)
-    filtered_sales = [s for s in sales if s.get('balance_amount', 0) > 0]
+    filtered_sales = await db.sales.find(
+        {"payment_type": "credit", "balance_amount": {"$gt": 0}},
+        {"_id": 0}
+    ).to_list(10000)
     for sale in filtered_sales:
-        if isinstance(sale['date'], str):
-            sale['date'] = datetime.fromisoformat(sale['date'])
-        if isinstance(sale['created_at'], str):
-            sale['created_at'] = datetime.fromisoformat(sale['created_at'])
+        from_storage(sale)
     return filtered_sales
 
 @api_router.get("/sales/{sale_id}", response_model=Sale)
@@ -876,10 +3139,7 @@ async def get_sale(sale_id: str):
     sale = await db.sales.find_one({"id": sale_id}, {"_id": 0})
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
-    if isinstance(sale['date'], str):
-        sale['date'] = datetime.fromisoformat(sale['date'])
-    if isinstance(sale['created_at'], str):
-        sale['created_at'] = datetime.fromisoformat(sale['created_at'])
+    from_storage(sale)
     return sale
 
 
@@ -894,13 +3154,15 @@ async def update_sale_payment(sale_id: str, amount_paid: float, balance_amount:
     payment_received = amount_paid - sale.get('amount_paid', 0)
     
     # Update sale record
-    await db.sales.update_one(
-        {"id": sale_id},
-        {"$set": {
-            "amount_paid": amount_paid,
-            "balance_amount": balance_amount
-        }}
-    )
+    async with revisions() as rev:
+        await db.sales.update_one(
+            {"id": sale_id},
+            {"$set": {
+                "amount_paid": amount_paid,
+                "balance_amount": balance_amount,
+                "rev": rev
+            }}
+        )
     
     # Update cash/gpay balance
     if payment_received > 0:
@@ -910,10 +3172,11 @@ async def update_sale_payment(sale_id: str, amount_paid: float, balance_amount:
             await update_balance(gpay_change=payment_received)
     
     updated_sale = await db.sales.find_one({"id": sale_id}, {"_id": 0})
-    if isinstance(updated_sale['date'], str):
-        updated_sale['date'] = datetime.fromisoformat(updated_sale['date'])
-    if isinstance(updated_sale['created_at'], str):
-        updated_sale['created_at'] = datetime.fromisoformat(updated_sale['created_at'])
+    from_storage(updated_sale)
+    # The daily report lists sales with their payment state
+    await report_cache.invalidate_date(updated_sale['date'])
+    if payment_received > 0:
+        publish_changes(balance=True)
     
     return updated_sale
 
@@ -922,9 +3185,24 @@ async def update_sale_payment(sale_id: str, amount_paid: float, balance_amount:
 # ============= RETURN/REFUND ROUTES =============
 
 @api_router.post("/returns", response_model=Return)
-async def create_return(input: ReturnCreate):
+async def create_return(input: ReturnCreate, idempotency_key: Optional[str] = Header(None)):
+    async def saved(return_obj: Return):
+        await report_cache.invalidate_date(return_obj.date)
+        publish_changes(
+            balance=True,
+            items=[item.model_dump() for item in return_obj.items]
+        )
+    return await run_idempotent(
+        "returns", idempotency_key, input,
+        lambda session: record_return(input, session),
+        saved,
+        transactional=True
+    )
+
+async def record_return(input: ReturnCreate, session=None) -> Return:
+    """Write a return with its restocking and refund"""
     # Get original sale
-    sale = await db.sales.find_one({"id": input.sale_id}, {"_id": 0})
+    sale = await db.sales.find_one({"id": input.sale_id}, {"_id": 0}, session=session)
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
     
@@ -945,49 +3223,36 @@ async def create_return(input: ReturnCreate):
     
     return_obj = Return(**return_dict)
     
-    # Return items to stock
-    for item in input.items:
-        if item.product_id:
-            product = await db.products.find_one({"id": item.product_id}, {"_id": 0})
-            if product:
-                new_quantity = product['quantity'] + item.quantity
-                await db.products.update_one(
-                    {"id": item.product_id},
-                    {"$set": {"quantity": new_quantity, "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-        elif item.set_id:
-            product_set = await db.product_sets.find_one({"id": item.set_id}, {"_id": 0})
-            if product_set:
-                for set_item in product_set['items']:
-                    product = await db.products.find_one({"id": set_item['product_id']}, {"_id": 0})
-                    if product:
-                        new_quantity = product['quantity'] + (set_item['quantity'] * item.quantity)
-                        await db.products.update_one(
-                            {"id": set_item['product_id']},
-                            {"$set": {"quantity": new_quantity, "updated_at": datetime.now(timezone.utc).isoformat()}}
-                        )
-    
-    # Update balance for refund
-    if input.refund_method == "cash":
-        await update_balance(cash_change=-refund_amount)
-    else:
-        await update_balance(gpay_change=-refund_amount)
-    
-    doc = return_obj.model_dump()
-    doc['date'] = doc['date'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.returns.insert_one(doc)
+    # Return items to stock; one rev block for the products, then the return
+    products, sets = await load_items_catalog(return_dict['items'], session)
+    deltas = stock_deltas(return_dict['items'], sets, 1)
+    async with revisions(len(deltas) + 1, session) as first:
+        await apply_stock_deltas(deltas, products, session, first)
+        
+        # Update balance for refund
+        if input.refund_method == "cash":
+            await update_balance(cash_change=-refund_amount, session=session)
+        else:
+            await update_balance(gpay_change=-refund_amount, session=session)
+        
+        return_obj.rev = first + len(deltas)
+        doc = to_storage(return_obj)
+        await db.returns.insert_one(doc, session=session)
+    await bump_rollup(return_obj.date, return_rollup(doc), session=session)
     return return_obj
 
-@api_router.get("/returns", response_model=List[Return])
-async def get_returns():
-    returns = await db.returns.find({}, {"_id": 0}).to_list(10000)
-    for ret in returns:
-        if isinstance(ret['date'], str):
-            ret['date'] = datetime.fromisoformat(ret['date'])
-        if isinstance(ret['created_at'], str):
-            ret['created_at'] = datetime.fromisoformat(ret['created_at'])
-    return returns
+@api_router.get("/returns", response_model=Union[Page[Return], List[Return]])
+async def get_returns(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None,
+    sale_id: Optional[str] = None,
+    refund_method: Optional[Literal["cash", "gpay"]] = None
+):
+    """List returns; pass `limit`/`after` to page newest first"""
+    query = list_query("date", from_date, to_date, sale_id=sale_id, refund_method=refund_method)
+    return await list_documents(db.returns, query, "date", limit, after, 10000)
 
 
 # ============= REPORT ROUTES =============
@@ -1001,81 +3266,32 @@ async def get_daily_report(date: str):
         if target_date.tzinfo is None:
             target_date = target_date.replace(tzinfo=timezone.utc)
         start = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = target_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+        end = start + timedelta(days=1)
     except:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
     
-    # Get sales
-    sales = await db.sales.find({}, {"_id": 0}).to_list(10000)
-    filtered_sales = []
-    for sale in sales:
-        if isinstance(sale['date'], str):
-            sale_date = datetime.fromisoformat(sale['date'])
-        else:
-            sale_date = sale['date']
-        # Ensure timezone consistency
-        if sale_date.tzinfo is None:
-            sale_date = sale_date.replace(tzinfo=timezone.utc)
-        if start <= sale_date <= end:
-            filtered_sales.append(sale)
-    
-    # Calculate sales metrics
-    total_sales = sum(s['total'] for s in filtered_sales)
-    retail_sales = sum(s['total'] for s in filtered_sales if s['sale_type'] == 'retail')
-    wholesale_sales = sum(s['total'] for s in filtered_sales if s['sale_type'] == 'wholesale')
-    
-    # Calculate cost and profit
-    total_cost = 0
-    for sale in filtered_sales:
-        for item in sale['items']:
-            if item.get('product_id'):
-                product = await db.products.find_one({"id": item['product_id']}, {"_id": 0})
-                if product:
-                    total_cost += product['cost_price'] * item['quantity']
-    
-    # Get expenses
-    expenses = await db.expenses.find({}, {"_id": 0}).to_list(10000)
-    filtered_expenses = []
-    for exp in expenses:
-        if isinstance(exp['date'], str):
-            exp_date = datetime.fromisoformat(exp['date'])
-        else:
-            exp_date = exp['date']
-        # Ensure timezone consistency
-        if exp_date.tzinfo is None:
-            exp_date = exp_date.replace(tzinfo=timezone.utc)
-        if start <= exp_date <= end:
-            filtered_expenses.append(exp)
-    
-    total_expenses = sum(e['amount'] for e in filtered_expenses)
-    
-    # Group expenses by category
-    expense_by_category = {}
-    for exp in filtered_expenses:
-        cat_name = exp['category_name']
-        if cat_name not in expense_by_category:
-            expense_by_category[cat_name] = 0
-        expense_by_category[cat_name] += exp['amount']
-    
-    profit = total_sales - total_cost - total_expenses
+    # Only UTC days line up with the invalidation keys; other offsets bypass the cache
+    key = ("daily", day_key(start)) if start == day_start(start) else None
+    cached = await report_cache.get(key) if key else None
+    if cached is not None:
+        return {**cached, "date": date}
+    generation = await report_cache.generation()
+    
+    summary, sales_list, expenses_list = await asyncio.gather(
+        period_summary(start, end),
+        db.sales.find(date_range_match("date", start, end), {"_id": 0}).to_list(None),
+        db.expenses.find(date_range_match("date", start, end), {"_id": 0}).to_list(None)
+    )
     
-    return {
+    report = {
         "date": date,
-        "sales": {
-            "total": total_sales,
-            "retail": retail_sales,
-            "wholesale": wholesale_sales,
-            "count": len(filtered_sales)
-        },
-        "expenses": {
-            "total": total_expenses,
-            "by_category": expense_by_category
-        },
-        "cost": total_cost,
-        "profit": profit,
-        "sales_list": filtered_sales,
-        "expenses_list": filtered_expenses
+        **summary,
+        "sales_list": [from_storage(sale) for sale in sales_list],
+        "expenses_list": [from_storage(exp) for exp in expenses_list]
     }
+    if key:
+        await report_cache.put(key, report, generation, end)
+    return report
 
 @api_router.get("/reports/monthly")
 async def get_monthly_report(year: int, month: int):
@@ -1089,102 +3305,579 @@ async def get_monthly_report(year: int, month: int):
     except:
         raise HTTPException(status_code=400, detail="Invalid year or month")
     
-    # Get sales
-    sales = await db.sales.find({}, {"_id": 0}).to_list(10000)
-    filtered_sales = []
-    for sale in sales:
-        if isinstance(sale['date'], str):
-            sale_date = datetime.fromisoformat(sale['date'])
-        else:
-            sale_date = sale['date']
-        # Ensure timezone consistency
-        if sale_date.tzinfo is None:
-            sale_date = sale_date.replace(tzinfo=timezone.utc)
-        if start <= sale_date < end:
-            filtered_sales.append(sale)
-    
-    # Calculate sales metrics
-    total_sales = sum(s['total'] for s in filtered_sales)
-    retail_sales = sum(s['total'] for s in filtered_sales if s['sale_type'] == 'retail')
-    wholesale_sales = sum(s['total'] for s in filtered_sales if s['sale_type'] == 'wholesale')
-    
-    # Calculate cost
-    total_cost = 0
-    for sale in filtered_sales:
-        for item in sale['items']:
-            if item.get('product_id'):
-                product = await db.products.find_one({"id": item['product_id']}, {"_id": 0})
-                if product:
-                    total_cost += product['cost_price'] * item['quantity']
-    
-    # Get expenses
-    expenses = await db.expenses.find({}, {"_id": 0}).to_list(10000)
-    filtered_expenses = []
-    for exp in expenses:
-        if isinstance(exp['date'], str):
-            exp_date = datetime.fromisoformat(exp['date'])
-        else:
-            exp_date = exp['date']
-        # Ensure timezone consistency
-        if exp_date.tzinfo is None:
-            exp_date = exp_date.replace(tzinfo=timezone.utc)
-        if start <= exp_date < end:
-            filtered_expenses.append(exp)
+    key = ("monthly", start.strftime("%Y-%m"))
+    cached = await report_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = await report_cache.generation()
     
-    total_expenses = sum(e['amount'] for e in filtered_expenses)
+    summary = await period_summary(start, end)
     
-    # Group expenses by category
-    expense_by_category = {}
-    for exp in filtered_expenses:
-        cat_name = exp['category_name']
-        if cat_name not in expense_by_category:
-            expense_by_category[cat_name] = 0
-        expense_by_category[cat_name] += exp['amount']
-    
-    profit = total_sales - total_cost - total_expenses
+    report = {
+        "year": year,
+        "month": month,
+        **summary
+    }
+    await report_cache.put(key, report, generation, end)
+    return report
+
+# Most buckets a range report may return
+MAX_RANGE_BUCKETS = 1100
+
+def bucket_start(day: datetime, granularity: str) -> datetime:
+    """First day of the day/week (Monday)/month bucket containing `day`"""
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+def next_bucket(start: datetime, granularity: str) -> datetime:
+    if granularity == "week":
+        return start + timedelta(days=7)
+    if granularity == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start + timedelta(days=1)
+
+@api_router.get("/reports/range")
+async def get_range_report(
+    from_: str = Query(..., alias="from"),
+    to: str = Query(...),
+    granularity: Literal["day", "week", "month"] = "day"
+):
+    """Sales, cost, expenses and profit per day/week/month between two dates (inclusive)"""
+    try:
+        first_day = day_start(datetime.fromisoformat(from_))
+        last_day = day_start(datetime.fromisoformat(to))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    if last_day < first_day:
+        raise HTTPException(status_code=400, detail="'to' must not be before 'from'")
+    
+    # Empty buckets are filled in so the series has no gaps
+    buckets = {}
+    start = bucket_start(first_day, granularity)
+    while start <= last_day:
+        buckets[start] = {"start": day_key(start), "sales": 0, "sales_count": 0, "cost": 0, "expenses": 0}
+        start = next_bucket(start, granularity)
+        if len(buckets) > MAX_RANGE_BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Range exceeds {MAX_RANGE_BUCKETS} buckets; use a coarser granularity")
+    
+    rollups = await load_daily_rollups(first_day, last_day + timedelta(days=1))
+    for rollup in rollups:
+        bucket = buckets.get(bucket_start(day_start(datetime.fromisoformat(rollup['id'])), granularity))
+        if bucket is None:
+            continue
+        summary = summarise_rollups([rollup])
+        bucket['sales'] += summary['sales']['total']
+        bucket['sales_count'] += summary['sales']['count']
+        bucket['cost'] += summary['cost']
+        bucket['expenses'] += summary['expenses']['total']
+    
+    series = list(buckets.values())
+    for bucket in series:
+        bucket['profit'] = bucket['sales'] - bucket['cost'] - bucket['expenses']
     
     return {
+        "from": day_key(first_day),
+        "to": day_key(last_day),
+        "granularity": granularity,
+        "buckets": series,
+        "totals": {
+            "sales": sum(b['sales'] for b in series),
+            "sales_count": sum(b['sales_count'] for b in series),
+            "cost": sum(b['cost'] for b in series),
+            "expenses": sum(b['expenses'] for b in series),
+            "profit": sum(b['profit'] for b in series)
+        }
+    }
+
+@api_router.get("/reports/yearly")
+async def get_yearly_report(year: int, top_categories: int = Query(5, ge=1, le=50)):
+    """Monthly breakdown, year totals and top expense categories in one pass"""
+    try:
+        start = datetime(year, 1, 1, tzinfo=timezone.utc)
+        end = datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid year")
+    
+    # The cached report ranks every category; the requested top N is sliced per call
+    key = ("yearly", str(year))
+    cached = await report_cache.get(key)
+    if cached is not None:
+        return {**cached, "top_expense_categories": cached['top_expense_categories'][:top_categories]}
+    generation = await report_cache.generation()
+    
+    rollups = await load_daily_rollups(start, end)
+    by_month = {month: [] for month in range(1, 13)}
+    for rollup in rollups:
+        by_month[int(rollup['id'][5:7])].append(rollup)
+    
+    months = [{"month": month, **summarise_rollups(by_month[month])} for month in range(1, 13)]
+    totals = summarise_rollups(rollups)
+    top_expenses = sorted(totals['expenses']['by_category'].items(), key=lambda item: item[1], reverse=True)
+    total_sales = totals['sales']['total']
+    
+    report = {
         "year": year,
-        "month": month,
-        "sales": {
-            "total": total_sales,
-            "retail": retail_sales,
-            "wholesale": wholesale_sales,
-            "count": len(filtered_sales)
-        },
-        "expenses": {
-            "total": total_expenses,
-            "by_category": expense_by_category
-        },
-        "cost": total_cost,
-        "profit": profit
+        "months": months,
+        "totals": totals,
+        "top_expense_categories": [
+            {"name": name, "amount": amount} for name, amount in top_expenses
+        ],
+        "sales_split": {
+            "retail": totals['sales']['retail'],
+            "wholesale": totals['sales']['wholesale'],
+            "retail_share": totals['sales']['retail'] / total_sales if total_sales else 0.0,
+            "wholesale_share": totals['sales']['wholesale'] / total_sales if total_sales else 0.0
+        }
     }
+    await report_cache.put(key, report, generation, end)
+    return {**report, "top_expense_categories": report['top_expense_categories'][:top_categories]}
 
 @api_router.get("/reports/suppliers")
 async def get_supplier_report():
     """Get all supplier balances"""
-    transactions = await db.stock_transactions.find({}, {"_id": 0}).to_list(10000)
-    
-    # Group by supplier
-    suppliers = {}
-    for trans in transactions:
-        if trans.get('supplier_name'):
-            supplier = trans['supplier_name']
-            if supplier not in suppliers:
-                suppliers[supplier] = {
-                    "supplier_name": supplier,
-                    "total_purchases": 0,
-                    "total_paid": 0,
-                    "balance": 0,
-                    "transactions": []
-                }
-            suppliers[supplier]['total_purchases'] += trans.get('cost_price', 0) * trans.get('quantity', 0)
-            suppliers[supplier]['total_paid'] += trans.get('paid_amount', 0)
-            suppliers[supplier]['balance'] += trans.get('balance', 0)
-            suppliers[supplier]['transactions'].append(trans)
+    pipeline = [
+        {"$match": {"supplier_name": {"$nin": [None, ""]}}},
+        {"$group": {
+            "_id": "$supplier_name",
+            "total_purchases": {"$sum": {"$multiply": [
+                {"$ifNull": ["$cost_price", 0]},
+                {"$ifNull": ["$quantity", 0]}
+            ]}},
+            "total_paid": {"$sum": {"$ifNull": ["$paid_amount", 0]}},
+            "balance": {"$sum": {"$ifNull": ["$balance", 0]}},
+            "transaction_count": {"$sum": 1},
+            "last_transaction_date": {"$max": "$date"}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "_id": 0,
+            "supplier_name": "$_id",
+            "total_purchases": 1,
+            "total_paid": 1,
+            "balance": 1,
+            "transaction_count": 1,
+            "last_transaction_date": 1
+        }}
+    ]
+    suppliers = await db.stock_transactions.aggregate(pipeline).to_list(None)
+    return suppliers
+
+@api_router.get("/reports/suppliers/{supplier_name}/transactions")
+async def get_supplier_transactions(
+    supplier_name: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None
+):
+    """Page through one supplier's stock transactions, newest first"""
+    query = list_query("date", from_date, to_date, supplier_name=supplier_name)
+    items, next_cursor = await paginate(db.stock_transactions, query, "date", limit, after)
+    return {"items": items, "next_cursor": next_cursor}
+
+# ============= EXPORT ROUTES =============
+
+# Rows are pulled from the cursor in batches of this size, so memory stays
+# flat however many documents are exported
+EXPORT_BATCH_SIZE = 500
+
+EXPORTS = {
+    "sales": {
+        "collection": "sales",
+        "columns": [
+            "id", "date", "sale_type", "payment_type", "customer_name", "customer_phone",
+            "subtotal", "discount_type", "discount_value", "discount_amount", "total",
+            "payment_method", "amount_paid", "balance_amount"
+        ],
+        # Sales are flattened to one CSV row per line item
+        "item_columns": ["product_id", "set_id", "name", "quantity", "unit_price", "total", "cost_price"]
+    },
+    "expenses": {
+        "collection": "expenses",
+        "columns": ["id", "date", "category_id", "category_name", "amount", "payment_source", "description"],
+        "item_columns": []
+    },
+    "money-transfers": {
+        "collection": "money_transfers",
+        "columns": ["id", "date", "transfer_type", "amount", "description"],
+        "item_columns": []
+    }
+}
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _csv_line(values: list) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(["" if value is None else _export_value(value) for value in values])
+    return buffer.getvalue()
+
+async def export_lines(spec: dict, query: dict, format: str):
+    """Yield export lines straight from a batched cursor"""
+    columns = spec['columns']
+    item_columns = spec['item_columns']
+    if format == "csv":
+        yield _csv_line(columns + [f"item_{column}" for column in item_columns])
+    
+    # Legacy ISO-string dates sort before native ones, which is also their
+    # chronological order: they all predate the native-dates migration
+    cursor = db[spec['collection']].find(query, {"_id": 0}) \
+        .sort([("date", ASCENDING), ("id", ASCENDING)]) \
+        .batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        from_storage(doc)
+        if format == "ndjson":
+            yield json.dumps(doc, default=_export_value) + "\n"
+            continue
+        
+        row = [doc.get(column) for column in columns]
+        items = doc.get('items') or []
+        if item_columns and items:
+            for item in items:
+                yield _csv_line(row + [item.get(column) for column in item_columns])
+        else:
+            yield _csv_line(row + [None] * len(item_columns))
+
+@api_router.get("/export/{collection}")
+async def export_collection(
+    collection: str,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    from_date: Optional[datetime] = None,
+    to_date: Optional[datetime] = None
+):
+    """Stream sales, expenses or money transfers as NDJSON or CSV.
+
+    The date filter also matches legacy string dates until the native-dates
+    migration completes, so a monthly export never drops older rows.
+    """
+    spec = EXPORTS.get(collection)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"Unknown export: {collection}")
+    
+    query = list_query("date", from_date, to_date)
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"{collection}.{format}"
+    return StreamingResponse(
+        export_lines(spec, query, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# ============= ADMIN ROUTES =============
+
+async def backfill_sale_costs(batch_size: int = 500) -> int:
+    """Snapshot cost prices onto sale items recorded before cost tracking existed.
+
+    Uses the current product cost, which is the best information available for
+    historical sales. Safe to re-run: sales that are already priced are skipped.
+    The COGS each sale gains is added to its day's rollup, which reports read.
+    """
+    updated = 0
+    last_id = None
+    while True:
+        query = {"items": {"$elemMatch": {"cost_price": None}}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db.sales.find(query, {"_id": 1, "items": 1, "date": 1}).sort("_id", 1).to_list(batch_size)
+        if not batch:
+            break
+        
+        all_items = [item for sale in batch for item in sale['items']]
+        products, sets = await load_items_catalog(all_items)
+        cogs_changes = {}
+        async with revisions(len(batch)) as first:
+            operations = []
+            for index, sale in enumerate(batch):
+                from_storage(sale)
+                before = sale_cogs(sale['items'])
+                snapshot_item_costs(sale['items'], products, sets)
+                day = day_start(sale['date'])
+                cogs_changes[day] = cogs_changes.get(day, 0) + sale_cogs(sale['items']) - before
+                operations.append(UpdateOne({"_id": sale['_id']}, {"$set": {"items": sale['items'], "rev": first + index}}))
+            await db.sales.bulk_write(operations, ordered=False)
+        for day, change in cogs_changes.items():
+            if change:
+                await bump_rollup(day, {"cogs": change})
+        
+        updated += len(batch)
+        last_id = batch[-1]['_id']
+        logger.info(f"Backfilled cost prices on {updated} sales")
+    return updated
+
+@api_router.post("/admin/migrations/backfill-sale-costs")
+async def run_backfill_sale_costs():
+    """Snapshot cost prices onto existing sales"""
+    updated = await backfill_sale_costs()
+    await report_cache.clear()
+    return {"message": "Sale cost backfill complete", "updated": updated}
+
+
+# Collections holding DATE_FIELDS, in the order the migration rewrites them
+DATED_COLLECTIONS = [
+    "categories", "products", "product_sets", "expense_categories", "balances",
+    "expenses", "money_transfers", "sales", "returns",
+    "stock_transactions", "supplier_balances"
+]
+
+async def load_migration_state():
+    """Load which migrations have finished: native dates and the first rollup build"""
+    global legacy_string_dates, rollups_ready
+    state = await db.migrations.find_one({"id": "native_dates"}, {"_id": 0})
+    legacy_string_dates = not (state and state.get('status') == "complete")
+    state = await db.migrations.find_one({"id": "daily_rollups"}, {"_id": 0})
+    rollups_ready = bool(state and state.get('status') == "complete")
+
+# Seconds between re-reads of the migration markers, so a migration or rollup
+# rebuild finished by one worker switches every worker over
+MIGRATION_STATE_INTERVAL = float(os.environ.get('MIGRATION_STATE_INTERVAL', '30'))
+
+async def migration_state_loop():
+    while legacy_string_dates or not rollups_ready:
+        await asyncio.sleep(MIGRATION_STATE_INTERVAL)
+        try:
+            await load_migration_state()
+        except Exception as e:
+            logger.error(f"Reading migration state failed: {e}")
+
+async def ensure_daily_rollups():
+    """Build the rollups on first start so reports stop scanning the raw collections.
+
+    One worker builds them while holding a lease; the others pick the marker
+    up in migration_state_loop.
+    """
+    if rollups_ready or not await acquire_lease("daily_rollups_build", 3600):
+        return
+    await rebuild_rollups()
+
+async def migrate_native_dates(batch_size: int = 500) -> dict:
+    """Rewrite ISO-string dates as native BSON dates, batch by batch.
+
+    Progress is checkpointed per collection in db.migrations, so an interrupted
+    run resumes from the last converted batch.
+    """
+    global legacy_string_dates
+    state = await db.migrations.find_one({"id": "native_dates"}, {"_id": 0}) or {}
+    progress = state.get('progress', {})
+    await db.migrations.update_one(
+        {"id": "native_dates"},
+        {"$set": {"status": "running", "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
     
-    return list(suppliers.values())
+    converted = {}
+    string_dates = {"$or": [{field: {"$type": "string"}} for field in DATE_FIELDS]}
+    for name in DATED_COLLECTIONS:
+        collection = db[name]
+        converted[name] = 0
+        last_id = progress.get(name)
+        while True:
+            query = dict(string_dates)
+            if last_id is not None:
+                query = {"$and": [string_dates, {"_id": {"$gt": last_id}}]}
+            projection = {field: 1 for field in DATE_FIELDS}
+            batch = await collection.find(query, projection).sort("_id", 1).to_list(batch_size)
+            if not batch:
+                break
+            
+            operations = []
+            for doc in batch:
+                update = {
+                    field: as_utc(datetime.fromisoformat(doc[field]))
+                    for field in DATE_FIELDS
+                    if isinstance(doc.get(field), str)
+                }
+                operations.append(UpdateOne({"_id": doc['_id']}, {"$set": update}))
+            await collection.bulk_write(operations, ordered=False)
+            
+            last_id = batch[-1]['_id']
+            converted[name] += len(batch)
+            await db.migrations.update_one(
+                {"id": "native_dates"},
+                {"$set": {f"progress.{name}": last_id, "updated_at": datetime.now(timezone.utc)}}
+            )
+        if converted[name]:
+            logger.info(f"Converted dates on {converted[name]} {name} documents")
+    
+    await db.migrations.update_one(
+        {"id": "native_dates"},
+        {
+            "$set": {"status": "complete", "updated_at": datetime.now(timezone.utc)},
+            "$unset": {"progress": ""}
+        }
+    )
+    legacy_string_dates = False
+    return converted
+
+@api_router.post("/admin/migrations/native-dates")
+async def run_migrate_native_dates(batch_size: int = 500):
+    """Convert stored ISO-string dates into native BSON dates"""
+    converted = await migrate_native_dates(batch_size)
+    return {"message": "Native date migration complete", "converted": converted}
+
+@api_router.get("/admin/migrations")
+async def get_migrations():
+    """List the recorded state of data migrations"""
+    migrations = await db.migrations.find({}, {"_id": 0, "progress": 0}).to_list(100)
+    return migrations
+
+
+# ============= INDEXES =============
+
+def _unique_id_index():
+    return IndexModel([("id", ASCENDING)], unique=True)
+
+def _rev_index():
+    # GET /sync reads each collection in rev order past the client's token
+    return IndexModel([("rev", ASCENDING)])
+
+# Every index the API relies on, per collection. Created idempotently on startup.
+INDEXES = {
+    "categories": [_unique_id_index(), _rev_index()],
+    "products": [
+        _unique_id_index(),
+        _rev_index(),
+        # Partial rather than sparse: products saved without a code store null
+        IndexModel([("sku", ASCENDING)], unique=True, partialFilterExpression={"sku": {"$type": "string"}}),
+        IndexModel([("barcode", ASCENDING)], unique=True, partialFilterExpression={"barcode": {"$type": "string"}}),
+        IndexModel([("category_id", ASCENDING)]),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)])
+    ],
+    "product_sets": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("created_at", ASCENDING), ("id", ASCENDING)])
+    ],
+    "expense_categories": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("name", ASCENDING)])
+    ],
+    "expenses": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("date", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("category_id", ASCENDING)])
+    ],
+    "money_transfers": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("date", ASCENDING), ("id", ASCENDING)])
+    ],
+    "sales": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("date", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("payment_type", ASCENDING), ("balance_amount", ASCENDING)]),
+        IndexModel(
+            [("client_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"client_id": {"$type": "string"}}
+        )
+    ],
+    "returns": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("date", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("sale_id", ASCENDING)])
+    ],
+    "balances": [_unique_id_index()],
+    "stock_transactions": [
+        _unique_id_index(),
+        IndexModel([("supplier_name", ASCENDING), ("date", ASCENDING), ("id", ASCENDING)])
+    ],
+    "supplier_balances": [_unique_id_index()],
+    "migrations": [_unique_id_index()],
+    "inventory_valuation": [_unique_id_index()],
+    "daily_rollups": [
+        _unique_id_index(),
+        IndexModel([("date", ASCENDING)])
+    ],
+    "idempotency_keys": [
+        _unique_id_index(),
+        IndexModel([("created_at", ASCENDING)], expireAfterSeconds=86400)
+    ],
+    "cache_versions": [
+        _unique_id_index(),
+        # Keys only need to outlive a poll; one that expires and comes back
+        # restarts at version 1, which still reads as a change
+        IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=86400)
+    ],
+    "counters": [_unique_id_index()],
+    "tombstones": [
+        _unique_id_index(),
+        _rev_index(),
+        IndexModel([("deleted_at", ASCENDING)], expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 86400)
+    ],
+}
+
+async def ensure_indexes():
+    """Create any declared index that does not exist yet"""
+    for name, indexes in INDEXES.items():
+        try:
+            created = await db[name].create_indexes(indexes)
+            logger.info(f"Indexes ready on {name}: {', '.join(created)}")
+        except OperationFailure as e:
+            # e.g. duplicate ids in legacy data block a unique index; keep serving
+            logger.error(f"Failed to build indexes on {name}: {e}")
+
+@api_router.get("/admin/indexes")
+async def get_index_report():
+    """List declared indexes that are missing and existing indexes that are unused"""
+    report = []
+    for name, indexes in INDEXES.items():
+        collection = db[name]
+        existing = await collection.index_information()
+        declared = {index.document['name'] for index in indexes}
+        stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        report.append({
+            "collection": name,
+            "missing": sorted(declared - set(existing)),
+            "undeclared": sorted(set(existing) - declared - {"_id_"}),
+            "unused": sorted(
+                stat['name'] for stat in stats
+                if stat['accesses']['ops'] == 0 and stat['name'] != "_id_"
+            )
+        })
+    return report
+
+@api_router.get("/admin/transactions")
+async def get_transaction_mode():
+    """Report whether sales, returns and restocks run inside transactions"""
+    return {"mode": transaction_mode, "enabled": transactions_enabled}
+
+@api_router.post("/admin/rollups/rebuild")
+async def run_rebuild_rollups():
+    """Regenerate the daily rollups from raw sales, expenses, returns and transfers"""
+    days = await rebuild_rollups()
+    await report_cache.clear()
+    return {"message": "Daily rollups rebuilt", "days": days}
+
+@api_router.get("/admin/cache/stats")
+async def get_cache_stats():
+    """Hit/miss counters for the in-process caches"""
+    return {
+        "backend": cache_backend.stats(),
+        "reports": report_cache.stats(),
+        "catalog": await catalog_cache.stats(),
+        "sync": cache_sync.stats(),
+        "events": event_bus.stats()
+    }
 
+@api_router.post("/admin/inventory/reconcile")
+async def run_reconcile_inventory_valuation():
+    """Check inventory valuation totals against the products and report the drift found.
+
+    Without transactions drift is only corrected once two runs in a row find
+    it, so call this twice to settle a mismatch by hand.
+    """
+    drift = await reconcile_inventory_valuation()
+    return {"message": "Inventory valuation reconciled", "drift": drift}
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -1204,6 +3897,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Long-running tasks started with the app, cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def startup_db_client():
+    await ensure_indexes()
+    await detect_transaction_support()
+    await load_migration_state()
+    await ensure_inventory_valuation()
+    await ensure_daily_rollups()
+    await backfill_revs()
+    await search_index.rebuild()
+    background_tasks.append(asyncio.create_task(migration_state_loop()))
+    if INVENTORY_RECONCILE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(inventory_reconcile_loop()))
+    await cache_sync.start()
+    if event_bus.relayed:
+        await event_bus.create_log()
+        background_tasks.append(asyncio.create_task(event_bus.relay_loop()))
+        background_tasks.append(asyncio.create_task(event_bus.presence_loop()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await cache_sync.flush()
+    await cache_backend.close()
     client.close()
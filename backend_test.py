@@ -1,5 +1,6 @@
 import requests
 import sys
+import time
 from datetime import datetime, date
 import json
 
@@ -17,10 +18,10 @@ class BillingAPITester:
             'sales': []
         }
 
-    def run_test(self, name, method, endpoint, expected_status, data=None, params=None):
+    def run_test(self, name, method, endpoint, expected_status, data=None, params=None, headers=None):
         """Run a single API test"""
         url = f"{self.base_url}/{endpoint}"
-        headers = {'Content-Type': 'application/json'}
+        headers = {'Content-Type': 'application/json', **(headers or {})}
 
         self.tests_run += 1
         print(f"\nTesting {name}...")
@@ -176,6 +177,127 @@ class BillingAPITester:
 
         return True
 
+    def test_product_search(self):
+        """Test typeahead product search"""
+        print("\n" + "="*50)
+        print("TESTING PRODUCT SEARCH")
+        print("="*50)
+        
+        if not self.created_ids['products']:
+            print("No products available for search testing")
+            return False
+        product_id = self.created_ids['products'][0]
+        
+        # Prefix, substring and case-insensitive queries all find "Test Laptop"
+        for query in ["test", "LAPT", "st lap"]:
+            success, response = self.run_test(
+                f"Search Products for '{query}'",
+                "GET",
+                "products/search",
+                200,
+                params={"q": query, "limit": 50}
+            )
+            if not success:
+                return False
+            if product_id not in [result['id'] for result in response if result['type'] == "product"]:
+                print(f"Failed - Product {product_id} not found for query '{query}'")
+                return False
+        
+        self.run_test("Search Without Query", "GET", "products/search", 422)
+        
+        print("✓ Product search matches prefixes, substrings and any case")
+        return True
+
+    def test_product_codes(self):
+        """Test SKU/barcode lookup and selling by code"""
+        print("\n" + "="*50)
+        print("TESTING PRODUCT CODES")
+        print("="*50)
+        
+        if not self.created_ids['categories']:
+            print("No categories available for product code testing")
+            return False
+        
+        barcode = f"890{int(datetime.now().timestamp() * 1000)}"
+        success, product = self.run_test(
+            "Create Product With Barcode",
+            "POST",
+            "products",
+            200,
+            data={
+                "name": "Scanned Notebook",
+                "category_id": self.created_ids['categories'][0],
+                "quantity": 20.0,
+                "unit": "pieces",
+                "cost_price": 30.0,
+                "retail_price": 45.0,
+                "wholesale_price": 40.0,
+                "barcode": barcode
+            }
+        )
+        if not success:
+            return False
+        self.created_ids['products'].append(product['id'])
+        
+        success, found = self.run_test("Get Product By Code", "GET", f"products/by-code/{barcode}", 200)
+        if not success:
+            return False
+        if found['id'] != product['id']:
+            print(f"Failed - Code resolved to {found['id']}, expected {product['id']}")
+            return False
+        
+        self.run_test("Unknown Code", "GET", "products/by-code/no-such-code", 404)
+        
+        duplicate = {**{k: product[k] for k in ['category_id', 'quantity', 'unit', 'cost_price', 'retail_price', 'wholesale_price']},
+                     "name": "Duplicate Barcode", "barcode": barcode}
+        success, _ = self.run_test("Reject Duplicate Barcode", "POST", "products", 409, data=duplicate)
+        if not success:
+            return False
+        
+        # A code must identify one product whichever field holds it
+        clash = {**duplicate, "name": "SKU Matching Barcode", "barcode": None, "sku": barcode}
+        success, _ = self.run_test("Reject SKU Used As Barcode", "POST", "products", 409, data=clash)
+        if not success:
+            return False
+        
+        # Blank codes are stored as unset, so any number of products can leave them empty
+        for name in ("Blank Codes A", "Blank Codes B"):
+            success, blank = self.run_test(
+                f"Create Product With {name}", "POST", "products", 200,
+                data={**duplicate, "name": name, "sku": "", "barcode": ""}
+            )
+            if not success:
+                return False
+            self.created_ids['products'].append(blank['id'])
+            if blank['sku'] is not None or blank['barcode'] is not None:
+                print(f"Failed - Blank codes were stored: {blank}")
+                return False
+        
+        # Sell by code: name and retail price come from the product
+        success, sale = self.run_test(
+            "Create Sale By Code",
+            "POST",
+            "sales",
+            200,
+            data={
+                "sale_type": "retail",
+                "items": [{"code": barcode, "quantity": 2.0}],
+                "discount_type": "amount",
+                "discount_value": 0,
+                "payment_method": "cash"
+            }
+        )
+        if not success:
+            return False
+        self.created_ids['sales'].append(sale['id'])
+        item = sale['items'][0]
+        if item['product_id'] != product['id'] or item['name'] != "Scanned Notebook" or item['total'] != 90.0:
+            print(f"Failed - Sale item not resolved from code: {item}")
+            return False
+        
+        print("✓ Products resolve by barcode and sell by code")
+        return True
+
     def test_sets(self):
         """Test product set operations"""
         print("\n" + "="*50)
@@ -423,6 +545,69 @@ class BillingAPITester:
         
         return success
 
+    def test_sale_cost_snapshot(self):
+        """Test that sales snapshot item and set component costs"""
+        print("\n" + "="*50)
+        print("TESTING SALE COST SNAPSHOT")
+        print("="*50)
+        
+        if not self.created_ids['products'] or not self.created_ids['sets']:
+            print("No products or sets available for cost snapshot testing")
+            return False
+        
+        success, product = self.run_test("Get Product Cost", "GET", f"products/{self.created_ids['products'][0]}", 200)
+        if not success:
+            return False
+        success, product_set = self.run_test("Get Set Components", "GET", f"sets/{self.created_ids['sets'][0]}", 200)
+        if not success:
+            return False
+        component_costs = {}
+        for set_item in product_set['items']:
+            success, component = self.run_test("Get Component Cost", "GET", f"products/{set_item['product_id']}", 200)
+            if not success:
+                return False
+            component_costs[set_item['product_id']] = component['cost_price']
+        
+        success, sale = self.run_test(
+            "Create Sale With Product And Set",
+            "POST",
+            "sales",
+            200,
+            data={
+                "sale_type": "retail",
+                "items": [
+                    {"product_id": product['id'], "name": product['name'], "quantity": 2.0, "unit_price": 100.0, "total": 200.0},
+                    {"set_id": product_set['id'], "name": product_set['name'], "quantity": 3.0, "unit_price": 50.0, "total": 150.0}
+                ],
+                "discount_type": "amount",
+                "discount_value": 0,
+                "payment_method": "cash"
+            }
+        )
+        if not success:
+            return False
+        self.created_ids['sales'].append(sale['id'])
+        
+        product_item, set_item = sale['items']
+        if product_item.get('cost_price') != product['cost_price']:
+            print(f"Failed - Product item cost {product_item.get('cost_price')}, expected {product['cost_price']}")
+            return False
+        
+        expected_components = [
+            {"product_id": item['product_id'], "quantity": item['quantity'], "cost_price": component_costs[item['product_id']]}
+            for item in product_set['items']
+        ]
+        if set_item.get('components') != expected_components:
+            print(f"Failed - Set components {set_item.get('components')}, expected {expected_components}")
+            return False
+        expected_set_cost = sum(c['quantity'] * c['cost_price'] for c in expected_components)
+        if abs((set_item.get('cost_price') or 0) - expected_set_cost) > 0.001:
+            print(f"Failed - Set item cost {set_item.get('cost_price')}, expected {expected_set_cost}")
+            return False
+        
+        print("✓ Sale items carry their cost snapshot")
+        return True
+
     def test_reports(self):
         """Test report generation"""
         print("\n" + "="*50)
@@ -453,9 +638,140 @@ class BillingAPITester:
             200,
             params={"year": current_year, "month": current_month}
         )
+        if not success:
+            return False
+        
+        # Test range report with empty buckets filled in
+        month_start = date(current_year, current_month, 1).isoformat()
+        success, response = self.run_test(
+            "Get Range Report",
+            "GET",
+            "reports/range",
+            200,
+            params={"from": month_start, "to": today, "granularity": "day"}
+        )
+        if not success:
+            return False
+        
+        expected_days = (date.today() - date(current_year, current_month, 1)).days + 1
+        if len(response.get('buckets', [])) != expected_days:
+            print(f"Failed - Expected {expected_days} daily buckets, got {len(response.get('buckets', []))}")
+            return False
+        
+        success, response = self.run_test(
+            "Get Yearly Report",
+            "GET",
+            "reports/yearly",
+            200,
+            params={"year": current_year}
+        )
+        if not success:
+            return False
+        
+        if len(response.get('months', [])) != 12:
+            print(f"Failed - Expected 12 months in yearly report, got {len(response.get('months', []))}")
+            return False
+        
+        success, response = self.run_test(
+            "Reject Reversed Range",
+            "GET",
+            "reports/range",
+            400,
+            params={"from": today, "to": month_start if month_start != today else "2000-01-01"}
+        )
         
         return success
 
+    def test_report_cache(self):
+        """Test that daily reports are cached and that a new expense invalidates them"""
+        print("\n" + "="*50)
+        print("TESTING REPORT CACHE")
+        print("="*50)
+        
+        if not self.created_ids['expense_categories']:
+            print("No expense categories available for report cache testing")
+            return False
+        
+        today = date.today().isoformat()
+        success, first = self.run_test("Daily Report To Cache", "GET", "reports/daily", 200, params={"date": today})
+        if not success:
+            return False
+        success, before = self.run_test("Get Cache Stats Before Repeat", "GET", "admin/cache/stats", 200)
+        if not success:
+            return False
+        success, _ = self.run_test("Daily Report From Cache", "GET", "reports/daily", 200, params={"date": today})
+        if not success:
+            return False
+        success, after = self.run_test("Get Cache Stats After Repeat", "GET", "admin/cache/stats", 200)
+        if not success:
+            return False
+        if after['reports']['hits'] <= before['reports']['hits']:
+            print("Failed - Repeated daily report was not served from the cache")
+            return False
+        
+        # Writing an expense for today must drop the cached report
+        expense_data = {
+            "category_id": self.created_ids['expense_categories'][0],
+            "amount": 1.0,
+            "description": "Report cache invalidation check",
+            "date": f"{today}T12:00:00"
+        }
+        success, expense = self.run_test("Create Expense For Today", "POST", "expenses", 200, data=expense_data)
+        if not success:
+            return False
+        self.created_ids['expenses'].append(expense['id'])
+        
+        success, report = self.run_test("Daily Report After Expense", "GET", "reports/daily", 200, params={"date": today})
+        if not success:
+            return False
+        if expense['id'] not in [exp['id'] for exp in report['expenses_list']]:
+            print("Failed - Daily report is missing the new expense")
+            return False
+        if abs(report['expenses']['total'] - first['expenses']['total'] - 1.0) > 0.01:
+            print(f"Failed - Expense total went from {first['expenses']['total']} to {report['expenses']['total']}")
+            return False
+        
+        print("✓ Daily reports are cached and invalidated by writes")
+        return True
+
+    def test_rollup_rebuild(self):
+        """Test that rebuilding the daily rollups leaves reports unchanged"""
+        print("\n" + "="*50)
+        print("TESTING ROLLUP REBUILD")
+        print("="*50)
+        
+        today = date.today().isoformat()
+        success, before = self.run_test("Daily Report Before Rebuild", "GET", "reports/daily", 200, params={"date": today})
+        if not success:
+            return False
+        
+        success, response = self.run_test("Rebuild Daily Rollups", "POST", "admin/rollups/rebuild", 200)
+        if not success:
+            return False
+        if before['sales']['count'] and response.get('days', 0) < 1:
+            print(f"Failed - Rebuild reported no days despite sales today: {response}")
+            return False
+        
+        success, after = self.run_test("Daily Report After Rebuild", "GET", "reports/daily", 200, params={"date": today})
+        if not success:
+            return False
+        
+        # The incrementally maintained rollup must match one rebuilt from raw data
+        checks = [
+            ("sales total", before['sales']['total'], after['sales']['total']),
+            ("sales count", before['sales']['count'], after['sales']['count']),
+            ("expenses total", before['expenses']['total'], after['expenses']['total']),
+            ("cost", before['cost'], after['cost']),
+            ("profit", before['profit'], after['profit'])
+        ]
+        for label, expected, actual in checks:
+            if abs(expected - actual) > 0.01:
+                print(f"Failed - {label} changed on rebuild: {expected} -> {actual}")
+                return False
+        
+        print("✓ Reports match before and after a rollup rebuild")
+        return True
+
     def test_balance_system(self):
         """Test Cash/GPay Balance System"""
         print("\n" + "="*50)
@@ -1572,6 +1888,56 @@ class BillingAPITester:
         print("✓ Category editing working correctly")
         return True
 
+    def test_catalog_cache(self):
+        """Test that renames invalidate the catalog cache"""
+        print("\n" + "="*50)
+        print("TESTING CATALOG CACHE")
+        print("="*50)
+        
+        success, category = self.run_test("Create Category To Cache", "POST", "categories", 200, data={"name": "Cached Category"})
+        if not success:
+            return False
+        self.created_ids['categories'].append(category['id'])
+        
+        product_data = {
+            "category_id": category['id'],
+            "quantity": 1.0,
+            "unit": "pieces",
+            "cost_price": 1.0,
+            "retail_price": 2.0,
+            "wholesale_price": 1.5
+        }
+        # Creating a product looks the category up, which caches it
+        success, product = self.run_test("Create Product In Cached Category", "POST", "products", 200, data={**product_data, "name": "Cache Test A"})
+        if not success:
+            return False
+        self.created_ids['products'].append(product['id'])
+        
+        success, before = self.run_test("Get Cache Stats Before Rename", "GET", "admin/cache/stats", 200)
+        if not success:
+            return False
+        success, _ = self.run_test("Rename Cached Category", "PUT", f"categories/{category['id']}", 200, data={"name": "Renamed Category"})
+        if not success:
+            return False
+        success, after = self.run_test("Get Cache Stats After Rename", "GET", "admin/cache/stats", 200)
+        if not success:
+            return False
+        if after['catalog']['versions']['categories'] <= before['catalog']['versions']['categories']:
+            print("Failed - Category rename did not bump the catalog version")
+            return False
+        
+        # The next lookup must see the new name, not the cached one
+        success, product = self.run_test("Create Product After Rename", "POST", "products", 200, data={**product_data, "name": "Cache Test B"})
+        if not success:
+            return False
+        self.created_ids['products'].append(product['id'])
+        if product['category_name'] != "Renamed Category":
+            print(f"Failed - Product got stale category name {product['category_name']}")
+            return False
+        
+        print("✓ Category rename invalidates the catalog cache")
+        return True
+
     def test_inventory_total_value(self):
         """Test Inventory Total Value"""
         print("\n" + "="*50)
@@ -1596,6 +1962,146 @@ class BillingAPITester:
                 return False
                 
         print(f"✓ Inventory Total Value - Cost: {response['total_cost_value']}, Retail: {response['total_retail_value']}, Wholesale: {response['total_wholesale_value']}, Items: {response['total_items']}")
+
+        # The running totals should agree with a full recomputation
+        success, reconcile_response = self.run_test(
+            "Reconcile Inventory Valuation",
+            "POST",
+            "admin/inventory/reconcile",
+            200
+        )
+        if not success:
+            return False
+        if reconcile_response.get('drift'):
+            print(f"Failed - Inventory valuation drifted: {reconcile_response['drift']}")
+            return False
+
+        print("✓ Inventory valuation totals match the products")
+        return True
+
+    def test_inventory_summary(self):
+        """Test Per-Category Inventory Summary"""
+        print("\n" + "="*50)
+        print("TESTING INVENTORY SUMMARY")
+        print("="*50)
+        
+        success, response = self.run_test(
+            "Get Inventory Summary",
+            "GET",
+            "inventory/summary",
+            200,
+            params={"low_stock_threshold": 5}
+        )
+        if not success:
+            return False
+        
+        for field in ['low_stock_threshold', 'categories', 'totals']:
+            if field not in response:
+                print(f"Failed - Missing field in inventory summary response: {field}")
+                return False
+        
+        # Category rows must add up to the totals
+        sku_count = sum(category['sku_count'] for category in response['categories'])
+        if sku_count != response['totals']['sku_count']:
+            print(f"Failed - Category SKU counts ({sku_count}) do not add up to the total ({response['totals']['sku_count']})")
+            return False
+        
+        # And agree with the valuation totals
+        success, total_value = self.run_test(
+            "Get Inventory Total Value",
+            "GET",
+            "inventory/total-value",
+            200
+        )
+        if not success:
+            return False
+        if abs(total_value['total_cost_value'] - response['totals']['cost_value']) > 0.01:
+            print(f"Failed - Summary cost value {response['totals']['cost_value']} != total value {total_value['total_cost_value']}")
+            return False
+        
+        self.run_test("Negative Threshold Rejected", "GET", "inventory/summary", 422, params={"low_stock_threshold": -1})
+        
+        print(f"✓ Inventory summary - {len(response['categories'])} categories, {response['totals']['out_of_stock']} out of stock, {response['totals']['low_stock']} low stock")
+        return True
+
+    def test_supplier_report(self):
+        """Test supplier totals and paged supplier transactions"""
+        print("\n" + "="*50)
+        print("TESTING SUPPLIER REPORT")
+        print("="*50)
+        
+        if not self.created_ids['categories']:
+            print("No categories available for supplier testing")
+            return False
+        
+        supplier = f"Supplier {int(datetime.now().timestamp() * 1000)}"
+        success, product = self.run_test(
+            "Create Product For Supplier",
+            "POST",
+            "products",
+            200,
+            data={
+                "name": "Supplier Test Glue",
+                "category_id": self.created_ids['categories'][0],
+                "quantity": 0.0,
+                "unit": "pieces",
+                "cost_price": 5.0,
+                "retail_price": 9.0,
+                "wholesale_price": 8.0
+            }
+        )
+        if not success:
+            return False
+        self.created_ids['products'].append(product['id'])
+        
+        restocks = [
+            {"quantity": 10.0, "cost_price": 5.0, "supplier_name": supplier, "paid_amount": 20.0, "payment_source": "cash"},
+            {"quantity": 4.0, "cost_price": 6.0, "supplier_name": supplier, "paid_amount": 24.0, "payment_source": "cash"}
+        ]
+        for index, restock in enumerate(restocks):
+            success, _ = self.run_test(f"Restock From Supplier {index + 1}", "POST", f"products/{product['id']}/restock", 200, data=restock)
+            if not success:
+                return False
+        
+        success, report = self.run_test("Get Supplier Report", "GET", "reports/suppliers", 200)
+        if not success:
+            return False
+        row = next((row for row in report if row['supplier_name'] == supplier), None)
+        if row is None:
+            print(f"Failed - {supplier} missing from the supplier report")
+            return False
+        if 'transactions' in row:
+            print("Failed - Supplier report should no longer embed transactions")
+            return False
+        expected = {"total_purchases": 74.0, "total_paid": 44.0, "balance": 30.0, "transaction_count": 2}
+        for field, value in expected.items():
+            if abs(row[field] - value) > 0.01:
+                print(f"Failed - {field} is {row[field]}, expected {value}")
+                return False
+        print("✓ Supplier totals are correct")
+        
+        # Page through the transactions one at a time, newest first
+        endpoint = f"reports/suppliers/{supplier}/transactions"
+        success, first = self.run_test("Get First Supplier Transaction", "GET", endpoint, 200, params={"limit": 1})
+        if not success:
+            return False
+        if len(first['items']) != 1 or not first['next_cursor']:
+            print(f"Failed - Expected one transaction and a cursor, got {first}")
+            return False
+        success, second = self.run_test(
+            "Get Next Supplier Transaction", "GET", endpoint, 200, params={"limit": 1, "after": first['next_cursor']}
+        )
+        if not success:
+            return False
+        if len(second['items']) != 1 or second['next_cursor'] is not None:
+            print(f"Failed - Expected the last transaction and no cursor, got {second}")
+            return False
+        quantities = [first['items'][0]['quantity'], second['items'][0]['quantity']]
+        if quantities != [4.0, 10.0]:
+            print(f"Failed - Expected the restocks newest first, got quantities {quantities}")
+            return False
+        
+        print("✓ Supplier transactions page newest first")
         return True
 
     def test_returns_refunds(self):
@@ -2006,6 +2512,356 @@ class BillingAPITester:
         print("✅ Valid operations still work correctly!")
         return True
 
+    def test_idempotency(self):
+        """Test Idempotency-Key handling on sale creation"""
+        print("\n" + "="*50)
+        print("TESTING IDEMPOTENCY KEYS")
+        print("="*50)
+        
+        if not self.created_ids['products']:
+            print("No products available for idempotency testing")
+            return False
+        product_id = self.created_ids['products'][0]
+        
+        success, product_before = self.run_test("Get Product Before Sale", "GET", f"products/{product_id}", 200)
+        if not success:
+            return False
+        
+        sale_data = {
+            "sale_type": "retail",
+            "items": [{
+                "product_id": product_id,
+                "name": "Idempotent Item",
+                "quantity": 1.0,
+                "unit_price": 100.0,
+                "total": 100.0
+            }],
+            "discount_type": "amount",
+            "discount_value": 0,
+            "payment_method": "cash"
+        }
+        key = {"Idempotency-Key": f"test-sale-{datetime.now().timestamp()}"}
+        
+        success, first = self.run_test("Create Sale With Idempotency Key", "POST", "sales", 200, data=sale_data, headers=key)
+        if not success:
+            return False
+        self.created_ids['sales'].append(first['id'])
+        
+        success, retry = self.run_test("Retry Sale With Same Key", "POST", "sales", 200, data=sale_data, headers=key)
+        if not success:
+            return False
+        if retry['id'] != first['id']:
+            print(f"Failed - Retry created a second sale: {retry['id']} != {first['id']}")
+            return False
+        
+        success, product_after = self.run_test("Get Product After Retry", "GET", f"products/{product_id}", 200)
+        if not success:
+            return False
+        if abs(product_before['quantity'] - product_after['quantity'] - 1.0) > 0.001:
+            print(f"Failed - Stock moved by {product_before['quantity'] - product_after['quantity']}, expected 1")
+            return False
+        
+        changed = {**sale_data, "discount_value": 10}
+        success, _ = self.run_test("Reuse Key For Different Sale", "POST", "sales", 422, data=changed, headers=key)
+        if not success:
+            return False
+        
+        print("✓ Idempotency keys replay the original sale without repeating its effects")
+        return True
+
+    def test_sale_batch(self):
+        """Test batch sale ingestion for offline POS sync"""
+        print("\n" + "="*50)
+        print("TESTING SALE BATCH")
+        print("="*50)
+        
+        if not self.created_ids['products']:
+            print("No products available for batch testing")
+            return False
+        product_id = self.created_ids['products'][0]
+        
+        success, product_before = self.run_test("Get Product Before Batch", "GET", f"products/{product_id}", 200)
+        if not success:
+            return False
+        
+        run_id = datetime.now().timestamp()
+        def offline_sale(client_id, item_product_id=product_id):
+            return {
+                "client_id": client_id,
+                "sale_type": "retail",
+                "items": [{
+                    "product_id": item_product_id,
+                    "name": "Offline Item",
+                    "quantity": 1.0,
+                    "unit_price": 50.0,
+                    "total": 50.0
+                }],
+                "discount_type": "amount",
+                "discount_value": 0,
+                "payment_method": "cash"
+            }
+        batch = {"sales": [
+            offline_sale(f"pos-{run_id}-1"),
+            offline_sale(f"pos-{run_id}-2"),
+            offline_sale(f"pos-{run_id}-1"),
+            offline_sale(f"pos-{run_id}-3", "missing-product")
+        ]}
+        
+        success, response = self.run_test("Create Sale Batch", "POST", "sales/batch", 200, data=batch)
+        if not success:
+            return False
+        statuses = [result['status'] for result in response['results']]
+        if statuses != ["created", "created", "duplicate", "rejected"]:
+            print(f"Failed - Unexpected batch results: {statuses}")
+            return False
+        self.created_ids['sales'].extend(r['sale_id'] for r in response['results'] if r['status'] == "created")
+        
+        # Replaying the whole batch must not create anything
+        success, replay = self.run_test("Replay Sale Batch", "POST", "sales/batch", 200, data=batch)
+        if not success:
+            return False
+        if replay['created'] != 0:
+            print(f"Failed - Replay created {replay['created']} sales")
+            return False
+        
+        success, product_after = self.run_test("Get Product After Batch", "GET", f"products/{product_id}", 200)
+        if not success:
+            return False
+        if abs(product_before['quantity'] - product_after['quantity'] - 2.0) > 0.001:
+            print(f"Failed - Stock moved by {product_before['quantity'] - product_after['quantity']}, expected 2")
+            return False
+        
+        self.run_test("Empty Batch Rejected", "POST", "sales/batch", 422, data={"sales": []})
+        
+        print("✓ Sale batch created each client sale once")
+        return True
+
+    def test_events(self):
+        """Test the live events stream"""
+        print("\n" + "="*50)
+        print("TESTING LIVE EVENTS")
+        print("="*50)
+        
+        self.tests_run += 1
+        print("\nTesting Open Events Stream...")
+        try:
+            with requests.get(f"{self.base_url}/events", stream=True, timeout=5) as response:
+                if response.status_code != 200 or not response.headers.get('content-type', '').startswith("text/event-stream"):
+                    print(f"Failed - Status {response.status_code}, content type {response.headers.get('content-type')}")
+                    return False
+                lines = response.iter_lines(decode_unicode=True)
+                first_line = next(lines)
+                if not first_line.startswith("retry:"):
+                    print(f"Failed - Unexpected first line: {first_line}")
+                    return False
+                self.tests_passed += 1
+                print("Passed - Stream opened")
+                
+                # A committed write must reach the open stream
+                success, _ = self.run_test(
+                    "Deposit Cash While Streaming", "POST", "money-transfers", 200,
+                    data={"transfer_type": "cash_deposit", "amount": 1.0, "description": "Live events check"}
+                )
+                if not success:
+                    return False
+                self.tests_run += 1
+                print("\nTesting Balance Event Arrives...")
+                deadline = time.monotonic() + 5
+                for line in lines:
+                    if line == "event: balance":
+                        break
+                    if time.monotonic() > deadline:
+                        print("Failed - No balance event within 5 seconds of the deposit")
+                        return False
+                else:
+                    print("Failed - Stream closed before a balance event arrived")
+                    return False
+                self.tests_passed += 1
+                print("Passed - Balance event received")
+        except Exception as e:
+            print(f"Failed - Error: {str(e)}")
+            return False
+        
+        print("✓ Events stream delivers committed changes")
+        return True
+
+    def test_sync(self):
+        """Test delta sync with rev tokens and tombstones"""
+        print("\n" + "="*50)
+        print("TESTING DELTA SYNC")
+        print("="*50)
+        
+        # Full sync: follow the token until nothing is left
+        token = None
+        for _ in range(1000):
+            params = {"limit": 500}
+            if token:
+                params["since"] = token
+            success, response = self.run_test("Sync Page", "GET", "sync", 200, params=params)
+            if not success:
+                return False
+            token = response['token']
+            if not response['has_more']:
+                break
+        
+        success, category = self.run_test("Create Category To Sync", "POST", "categories", 200, data={"name": "Sync Category"})
+        if not success:
+            return False
+        if not category.get('rev'):
+            print(f"Failed - Created category has no rev: {category}")
+            return False
+        
+        success, response = self.run_test("Sync Since Token", "GET", "sync", 200, params={"since": token})
+        if not success:
+            return False
+        synced = [c for c in response['changes']['categories'] if c['id'] == category['id']]
+        if len(synced) != 1:
+            print(f"Failed - New category not in delta: {response['changes']['categories']}")
+            return False
+        other = sum(len(docs) for name, docs in response['changes'].items() if name != "categories")
+        print(f"✓ Delta holds the new category ({other} other changes)")
+        token = response['token']
+        
+        success, renamed = self.run_test(
+            "Rename Category To Sync", "PUT", f"categories/{category['id']}", 200, data={"name": "Sync Category 2"}
+        )
+        if not success:
+            return False
+        if renamed['rev'] <= category['rev']:
+            print(f"Failed - Rev did not grow on update: {category['rev']} -> {renamed['rev']}")
+            return False
+        self.run_test("Delete Category To Sync", "DELETE", f"categories/{category['id']}", 200)
+        
+        success, response = self.run_test("Sync Delete", "GET", "sync", 200, params={"since": token})
+        if not success:
+            return False
+        if category['id'] not in response['deleted']['categories']:
+            print(f"Failed - Deleted category not in tombstones: {response['deleted']}")
+            return False
+        print("✓ Delete reported as a tombstone")
+        
+        success, response = self.run_test("Sync Again", "GET", "sync", 200, params={"since": response['token']})
+        if not success:
+            return False
+        if any(c['id'] == category['id'] for c in response['changes']['categories']) or response['deleted']['categories']:
+            print("Failed - Repeated sync returned already synced changes")
+            return False
+        
+        self.run_test("Invalid Sync Token", "GET", "sync", 400, params={"since": "not-a-token"})
+        
+        print("✓ Sync returns only what changed since the token")
+        return True
+
+    def test_pagination(self):
+        """Test cursor-based pagination on list endpoints"""
+        print("\n" + "="*50)
+        print("TESTING PAGINATION")
+        print("="*50)
+        
+        # First page of sales
+        success, response = self.run_test(
+            "Get First Page of Sales",
+            "GET",
+            "sales",
+            200,
+            params={"limit": 1}
+        )
+        if not success:
+            return False
+        
+        if 'items' not in response or 'next_cursor' not in response:
+            print("Failed - Paginated response missing items or next_cursor")
+            return False
+        if len(response['items']) > 1:
+            print(f"Failed - Expected at most 1 sale, got {len(response['items'])}")
+            return False
+        
+        # Follow the cursor to the next page
+        if response['next_cursor']:
+            first_id = response['items'][0]['id']
+            success, response = self.run_test(
+                "Get Next Page of Sales",
+                "GET",
+                "sales",
+                200,
+                params={"limit": 1, "after": response['next_cursor']}
+            )
+            if not success:
+                return False
+            if any(sale['id'] == first_id for sale in response['items']):
+                print("Failed - Next page repeated a sale from the first page")
+                return False
+        
+        # Filtered page of expenses
+        success, response = self.run_test(
+            "Get Cash Expenses Page",
+            "GET",
+            "expenses",
+            200,
+            params={"limit": 5, "payment_source": "cash"}
+        )
+        if not success:
+            return False
+        if any(exp['payment_source'] != 'cash' for exp in response['items']):
+            print("Failed - Expense filter returned non-cash expenses")
+            return False
+        
+        # Invalid cursor is rejected
+        success, _ = self.run_test(
+            "Reject Invalid Cursor",
+            "GET",
+            "sales",
+            400,
+            params={"limit": 1, "after": "not-a-cursor"}
+        )
+        return success
+
+    def test_exports(self):
+        """Test streaming NDJSON/CSV exports"""
+        print("\n" + "="*50)
+        print("TESTING EXPORTS")
+        print("="*50)
+        
+        for collection in ["sales", "expenses", "money-transfers"]:
+            for export_format in ["ndjson", "csv"]:
+                success, _ = self.run_test(
+                    f"Export {collection} as {export_format}",
+                    "GET",
+                    f"export/{collection}",
+                    200,
+                    params={"format": export_format}
+                )
+                if not success:
+                    return False
+        
+        # A date-filtered export holds exactly the rows dated in the range (UTC days)
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        self.tests_run += 1
+        print("\nTesting Date-Filtered Sales Export...")
+        response = requests.get(
+            f"{self.base_url}/export/sales",
+            params={"format": "ndjson", "from_date": f"{today}T00:00:00+00:00"}
+        )
+        rows = [json.loads(line) for line in response.text.splitlines() if line]
+        if response.status_code != 200 or any(row['date'][:10] < today for row in rows):
+            print(f"Failed - Status {response.status_code}, rows outside the range: {[row['date'] for row in rows if row['date'][:10] < today]}")
+            return False
+        success, sales = self.run_test("Get Sales", "GET", "sales", 200)
+        expected = sum(1 for sale in sales if sale['date'][:10] >= today)
+        if len(rows) != expected:
+            print(f"Failed - Export has {len(rows)} sales from today, the sales list has {expected}")
+            return False
+        self.tests_passed += 1
+        print(f"Passed - {len(rows)} sales exported for {today}")
+        
+        success, _ = self.run_test(
+            "Reject Unknown Export",
+            "GET",
+            "export/unknown",
+            404
+        )
+        return success
+
     def cleanup(self):
         """Clean up created test data"""
         print("\n" + "="*50)
@@ -2041,6 +2897,8 @@ def main():
         # Basic CRUD tests (setup for other tests)
         tester.test_categories,
         tester.test_products,
+        tester.test_product_search,
+        tester.test_product_codes,
         tester.test_expense_categories,
         
         # Critical features from review request
@@ -2053,14 +2911,26 @@ def main():
         tester.test_balance_validation_fixes,  # NEW: Test balance validation fixes to prevent negative balances
         tester.test_credit_sales,
         tester.test_category_editing,
+        tester.test_catalog_cache,
         tester.test_inventory_total_value,
+        tester.test_inventory_summary,
+        tester.test_supplier_report,
         tester.test_returns_refunds,
         
         # Additional tests
         tester.test_sets,
         tester.test_expenses,
         tester.test_sales,
-        tester.test_reports
+        tester.test_sale_cost_snapshot,
+        tester.test_idempotency,
+        tester.test_sale_batch,
+        tester.test_events,
+        tester.test_sync,
+        tester.test_pagination,
+        tester.test_exports,
+        tester.test_reports,
+        tester.test_report_cache,
+        tester.test_rollup_rebuild
     ]
     
     all_passed = True
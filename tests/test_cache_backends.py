@@ -0,0 +1,123 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# server.py reads its settings on import; Motor only connects on first use,
+# so these tests need no MongoDB
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "billing_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+def memory_cache():
+    return server.MemoryCache()
+
+def redis_cache(connected=True):
+    fakeredis = pytest.importorskip("fakeredis")
+    fake_server = fakeredis.FakeServer()
+    fake_server.connected = connected
+    cache = server.RedisCache("redis://localhost:6379/0")
+    cache.redis = fakeredis.aioredis.FakeRedis(server=fake_server)
+    return cache
+
+BACKENDS = {"memory": memory_cache, "redis": redis_cache}
+
+def run_with(kind, check):
+    """Build the backend inside the event loop that runs `check(cache)`"""
+    async def main():
+        cache = BACKENDS[kind]()
+        try:
+            await check(cache)
+        finally:
+            await cache.close()
+    asyncio.run(main())
+
+@pytest.mark.parametrize("kind", BACKENDS)
+def test_get_set_delete(kind):
+    async def check(cache):
+        assert await cache.get("a") is None
+        await cache.set("a", {"name": "Pen", "price": 10.0})
+        await cache.set_many({"b": [1, 2], "c": "text"})
+        assert await cache.get("a") == {"name": "Pen", "price": 10.0}
+        assert await cache.get_many(["a", "b", "c", "missing"]) == {
+            "a": {"name": "Pen", "price": 10.0}, "b": [1, 2], "c": "text"
+        }
+        await cache.delete("a", "b")
+        assert await cache.get_many(["a", "b", "c"]) == {"c": "text"}
+    run_with(kind, check)
+
+@pytest.mark.parametrize("kind", BACKENDS)
+def test_ttl(kind):
+    async def check(cache):
+        await cache.set("short", 1, ttl=0.05)
+        await cache.set("long", 2, ttl=60)
+        await cache.set("forever", 3)
+        await asyncio.sleep(0.15)
+        assert await cache.get_many(["short", "long", "forever"]) == {"long": 2, "forever": 3}
+    run_with(kind, check)
+
+@pytest.mark.parametrize("kind", BACKENDS)
+def test_tag_invalidation(kind):
+    async def check(cache):
+        await cache.set_many({"p1": 1, "p2": 2}, tags=("catalog", "catalog:products"))
+        await cache.set("s1", 3, tags=("catalog", "catalog:product_sets"))
+        await cache.set("r1", 4, tags=("reports",))
+        await cache.invalidate_tag("catalog:products")
+        assert await cache.get_many(["p1", "p2", "s1", "r1"]) == {"s1": 3, "r1": 4}
+        await cache.invalidate_tag("catalog")
+        assert await cache.get_many(["s1", "r1"]) == {"r1": 4}
+    run_with(kind, check)
+
+@pytest.mark.parametrize("kind", BACKENDS)
+def test_counters(kind):
+    async def check(cache):
+        assert await cache.counter("catalog:products") == 0
+        assert await cache.incr("catalog:products") == 1
+        assert await cache.incr("catalog:products") == 2
+        assert await cache.counter("catalog:products") == 2
+        assert await cache.counter("catalog:categories") == 0
+    run_with(kind, check)
+
+def test_memory_cache_evicts_least_recently_used():
+    async def check():
+        cache = server.MemoryCache(max_entries=2)
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        await cache.get("a")
+        await cache.set("c", 3)
+        assert await cache.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+    asyncio.run(check())
+
+def test_redis_errors_are_misses():
+    async def check():
+        cache = redis_cache(connected=False)
+        assert await cache.get_many(["a", "b"]) == {}
+        await cache.set("a", 1, tags=("catalog",))
+        await cache.delete("a")
+        await cache.invalidate_tag("catalog")
+        assert await cache.counter("catalog:products") == 0
+        assert await cache.incr("catalog:products") == 0
+        stats = cache.stats()
+        assert stats["errors"] == 6
+        assert stats["misses"] == 2
+    asyncio.run(check())
+
+def test_catalog_lookup_survives_redis_outage(monkeypatch):
+    """A POS lookup falls back to MongoDB when Redis is down"""
+    class Products:
+        def find(self, query, projection, session=None):
+            async def docs():
+                for product_id in query["$or"][0]["id"]["$in"]:
+                    yield {"id": product_id, "name": "Pen", "cost_price": 5.0}
+            return docs()
+
+    async def check():
+        catalog = server.CatalogCache(redis_cache(connected=False))
+        monkeypatch.setattr(server, "db", {"products": Products()})
+        found = await catalog.get_many("products", ["p1"])
+        assert found == {"p1": {"id": "p1", "name": "Pen", "cost_price": 5.0}}
+    asyncio.run(check())
@@ -0,0 +1,88 @@
+import requests
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class TransactionBenchmark:
+    """Measure POST /sales throughput against a running backend.
+
+    Run it once with the backend started with MONGO_TRANSACTIONS=on and once
+    with MONGO_TRANSACTIONS=off to compare both modes. Sales cannot be deleted,
+    so point it at a test database.
+    """
+
+    def __init__(self, base_url="http://localhost:7000/api", sales=500, workers=8):
+        self.base_url = base_url
+        self.sales = sales
+        self.workers = workers
+        self.session = requests.Session()
+
+    def post(self, endpoint, data):
+        response = self.session.post(f"{self.base_url}/{endpoint}", json=data)
+        response.raise_for_status()
+        return response.json()
+
+    def setup(self):
+        category = self.post("categories", {"name": "Benchmark"})
+        product = self.post("products", {
+            "name": "Benchmark Pen",
+            "category_id": category['id'],
+            "quantity": self.sales * 10,
+            "unit": "pieces",
+            "cost_price": 5.0,
+            "retail_price": 10.0,
+            "wholesale_price": 8.0
+        })
+        return category, product
+
+    def cleanup(self, category, product):
+        self.session.delete(f"{self.base_url}/products/{product['id']}")
+        self.session.delete(f"{self.base_url}/categories/{category['id']}")
+
+    def make_sale(self, product):
+        started = time.perf_counter()
+        self.post("sales", {
+            "sale_type": "retail",
+            "items": [{
+                "product_id": product['id'],
+                "name": product['name'],
+                "quantity": 1,
+                "unit_price": 10.0,
+                "total": 10.0
+            }],
+            "discount_type": "amount",
+            "discount_value": 0,
+            "payment_method": "cash"
+        })
+        return time.perf_counter() - started
+
+    def run(self):
+        mode = self.session.get(f"{self.base_url}/admin/transactions").json()
+        print(f"Transaction mode: {mode['mode']} (enabled: {mode['enabled']})")
+
+        category, product = self.setup()
+        try:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                latencies = sorted(pool.map(lambda _: self.make_sale(product), range(self.sales)))
+            elapsed = time.perf_counter() - started
+
+            final = self.session.get(f"{self.base_url}/products/{product['id']}").json()
+            lost_updates = final['quantity'] - (self.sales * 10 - self.sales)
+        finally:
+            self.cleanup(category, product)
+
+        print(f"Sales: {self.sales} with {self.workers} concurrent clients")
+        print(f"Throughput: {self.sales / elapsed:.1f} sales/s")
+        print(f"Latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+        print(f"Stock drift: {lost_updates}")
+        return lost_updates == 0
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:7000/api"
+    benchmark = TransactionBenchmark(base_url)
+    return 0 if benchmark.run() else 1
+
+if __name__ == "__main__":
+    sys.exit(main())